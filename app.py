@@ -1,9 +1,12 @@
 import functools
+import importlib
+import json
 import logging
 import math
-import threading
+import os
+import sys
+import time
 
-import requests
 from flask import (
     Flask,
     Response,
@@ -13,14 +16,12 @@ from flask import (
     send_file,
     url_for,
 )
-from flask_discord import DiscordOAuth2Session
-from flask_discord.exceptions import RateLimited
-from markdownify import markdownify as md
 from werkzeug.exceptions import RequestEntityTooLarge
 
-import patching
-from flows import BUG_REPORT_FILE, RELEASE_LOG_FILE, flow_lock, run_flows
-from forms import PatcherForm, VersionCreatorForm
+import report
+from jobs import DuplicateJob, FlowQueue
+from members import MemberCache
+from relay import DISCORD_DESCRIPTION_LIMIT, default_relay
 from taiga.config import (
     APP_SECRET,
     BETA_ROLE,
@@ -34,15 +35,56 @@ from taiga.config import (
     TEAM_ROLE,
     TAIGA_WEBHOOK,
 )
-from taiga.utils import REQUEST_TIMEOUT
+from taiga.mirror import BoardMirror
+
+
+class LazyModule:
+    """`name`, imported on its first attribute access rather than now.
+
+    For what only some routes need: a worker that only ever relays webhooks never
+    loads pysage-tools or the OAuth stack, and a restart does not wait on them.
+    Through `importlib.import_module` rather than `LazyLoader`, whose module is
+    visible half-run to a second thread that reaches it during the first's import
+    (fixed only in 3.12); the import lock makes that thread wait instead."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        return getattr(importlib.import_module(self._name), attribute)
+
+
+flask_discord = LazyModule("flask_discord")
+markdownify = LazyModule("markdownify")
+# Imports all of pysage-tools and builds the patch catalogue.
+patching = LazyModule("patching")
+flows = LazyModule("flows")
+forms = LazyModule("forms")
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s %(levelname)-8s %(message)s",
 )
 
-# Discord rejects the whole webhook payload if an embed exceeds these limits.
-DISCORD_DESCRIPTION_LIMIT = 4096
+REQUEST_BYTES_LIMIT = 16 * 1024 * 1024
+
+# No comment is converted past this much HTML, however little Markdown it gave.
+COMMENT_HTML_LIMIT = 256 * 1024
+
+# How often a progress stream looks at the release log, and how long one stream
+# may hold a worker before the browser is left to reconnect. Only a server that
+# takes requests on several threads streams at all: on a sync worker each request
+# answers with what is new and the browser asks again after the slower retry.
+PROGRESS_POLL_SECONDS = 0.5
+PROGRESS_STREAM_SECONDS = 60
+PROGRESS_RETRY_MS = 1000
+PROGRESS_SYNC_RETRY_MS = 3000
+
+# Patch runs waiting for a slot at which /healthz answers 503, for nginx to stop
+# sending uploads before they pile up behind the running ones.
+PATCH_BUSY_QUEUE = 2
+
+STARTED_AT = time.monotonic()
 
 app = Flask(__name__)
 
@@ -50,10 +92,54 @@ app.secret_key = APP_SECRET
 app.config["DISCORD_CLIENT_ID"] = CLIENT_ID  # Discord client ID.
 app.config["DISCORD_CLIENT_SECRET"] = CLIENT_SECRET  # Discord client secret.
 app.config["DISCORD_REDIRECT_URI"] = CLIENT_CALLBACK  # Discord client ID.
-app.config["MAX_CONTENT_LENGTH"] = patching.MAX_UPLOAD_BYTES
+# Anything but a patch upload, which raises its own limit: a Taiga event carrying a
+# pasted crash dump is the largest expected.
+app.config["MAX_CONTENT_LENGTH"] = REQUEST_BYTES_LIMIT
 app.url_map.strict_slashes = False
 
-discord = DiscordOAuth2Session(app)
+board_mirror = BoardMirror()
+flow_queue = FlowQueue()
+
+
+def run_flows(*args):
+    # Through the module, so starting the queue does not import the flows.
+    return flows.run_flows(*args)
+
+
+member_cache = MemberCache(GUILD_ID)
+# Anything left queued by a worker that restarted before it got to it.
+flow_queue.start(run_flows)
+default_relay.start()
+
+
+@functools.cache
+def discord():
+    """flask_discord's OAuth session, made when a page first needs it."""
+    return flask_discord.DiscordOAuth2Session(app)
+
+
+def comment_markdown(html: str, limit: int = DISCORD_DESCRIPTION_LIMIT) -> str:
+    """`html` as Markdown, cut to `limit` characters, converting no more of it than
+    that takes.
+
+    A pasted crash log can make a comment megabytes long, and only the start of it
+    fits in an embed. The HTML is converted in growing prefixes, each twice the
+    last, until one gives `limit` characters or the whole comment is done."""
+    end = limit * 2
+    while True:
+        prefix = html[: min(end, COMMENT_HTML_LIMIT)]
+        if len(prefix) < len(html):
+            # Not inside a tag, which would come out as text.
+            cut = prefix.rfind("<")
+            if cut > prefix.rfind(">"):
+                prefix = prefix[:cut]
+
+        text = markdownify.markdownify(prefix)
+        if len(text) >= limit or len(prefix) >= len(html) or end >= COMMENT_HTML_LIMIT:
+            break
+        end *= 2
+
+    return text[:limit]
 
 
 def scope_locked(team_only: bool):
@@ -63,16 +149,19 @@ def scope_locked(team_only: bool):
             if DEBUG:
                 return view(*args, **kwargs)
 
-            if not discord.authorized:
-                return discord.create_session(
+            if not discord().authorized:
+                return discord().create_session(
                     scope=["identify", "guilds", "guilds.members.read"],
                     prompt=False,
                     data={"next": request.endpoint},
                 )
 
             try:
-                member = discord.request(f"/users/@me/guilds/{GUILD_ID}/member")
-            except RateLimited:
+                member = member_cache.get(
+                    discord().get_authorization_token(),
+                    lambda: discord().request(f"/users/@me/guilds/{GUILD_ID}/member"),
+                )
+            except flask_discord.RateLimited:
                 return (
                     render_template(
                         "message.html",
@@ -118,7 +207,7 @@ def scope_locked(team_only: bool):
 def login():
     # discord.callback() completes the OAuth token exchange, so it must always run
     # before we inspect where to send the user next.
-    next_endpoint = discord.callback().get("next")
+    next_endpoint = discord().callback().get("next")
     if next_endpoint and next_endpoint in app.view_functions:
         return redirect(url_for(next_endpoint))
 
@@ -136,6 +225,25 @@ def taiga_webhook_receiver():
     if not data:
         return Response(status=400, response="Expected a JSON body")
 
+    # Taiga delivers an event again when an answer is slow or not a 2xx; the
+    # repeat is acknowledged and nothing else.
+    if not default_relay.first_delivery(data):
+        return Response(status=200, response="Skipped, already received")
+
+    try:
+        return relay_event(data)
+    except Exception:
+        # Taiga sends a delivery that failed again, and that repeat has to get
+        # through: forgotten, or the event would be lost.
+        default_relay.forget_delivery(data)
+        raise
+
+
+def relay_event(data: dict) -> Response:
+    # Ahead of the relay's filters: a deletion or the bot's own edit is not worth a
+    # Discord message, but it still changes the board.
+    board_mirror.apply_event(data)
+
     if data["action"] not in ["create", "change", "test"]:
         return Response(status=200, response="Skipped, incorrect action")
 
@@ -162,7 +270,7 @@ def taiga_webhook_receiver():
             and not data["change"]["edit_comment_date"]
         ):
             title = "Comment Added"
-            description = md(data["change"]["comment_html"])[:DISCORD_DESCRIPTION_LIMIT]
+            description = comment_markdown(data["change"]["comment_html"])
             fields.extend(
                 [
                     {
@@ -177,39 +285,42 @@ def taiga_webhook_receiver():
             )
 
     embed = {
+        "title": title,
+        "description": description,
+        "color": 5814783,
+        "fields": fields,
+        "thumbnail": {"url": thumbnail},
+    }
+    envelope = {
         "content": None,
-        "embeds": [
-            {
-                "title": title,
-                "description": description,
-                "color": 5814783,
-                "fields": fields,
-                "thumbnail": {"url": thumbnail},
-            }
-        ],
         "username": "Issue Tracker",
         "avatar_url": "https://imgur.com/mn40JxG.png",
         "attachments": [],
     }
 
-    response = requests.post(TAIGA_WEBHOOK, json=embed, timeout=REQUEST_TIMEOUT)
-    return Response(status=response.status_code, response=response.text)
+    # Acknowledged before Discord sees it: Taiga times out and sends the event again
+    # if the answer waits on Discord. The relay holds it for the rest of its burst,
+    # and merges it with the author's other events on the same ticket.
+    key = f"{(data.get('data') or {}).get('id')}:{data['by']['id']}"
+    default_relay.stage(TAIGA_WEBHOOK, envelope, key, embed)
+    return Response(status=202, response="Queued")
 
 
 def release_creator(is_beta: bool):
-    if flow_lock.locked():
-        try:
-            with open(RELEASE_LOG_FILE, "r") as f:
-                text = f.read()
-        except FileNotFoundError:
-            text = ""
-
+    # From the shared queue, so a flow started by another worker or by cli.py
+    # counts too.
+    jobs = flow_queue.pending()
+    if jobs and not any(job["state"] == "running" for job in jobs):
+        # Queued behind a runner that died, and nobody draining since.
+        flow_queue.start(run_flows)
+
+    if jobs:
         return (
             render_template(
                 "message.html",
                 message="Another flow is currently running, please try again later...",
                 status=423,
-                logs=text,
+                progress_url=url_for("flow_progress"),
             ),
             423,
         )
@@ -217,22 +328,86 @@ def release_creator(is_beta: bool):
     return _release_creator(is_beta)
 
 
+@app.route("/flow/progress")
+@scope_locked(team_only=True)
+def flow_progress():
+    """The release log as Server-Sent Events, each entry once.
+
+    An event's ID is the log's run and the byte offset after it, so a reconnecting
+    browser resumes from there. A stream holds a worker, so it ends after
+    `PROGRESS_STREAM_SECONDS` and the browser opens the next; it also ends once no
+    flow is left, with a `done` event.
+
+    On a server without threads to spare (`wsgi.multithread` unset, as under
+    gunicorn's sync worker), a held stream would keep the webhook and the patcher
+    waiting for as long as the page is open, so the answer is only what is new
+    and the browser polls."""
+    run, _, offset = request.headers.get("Last-Event-ID", "").partition(":")
+    offset = int(offset) if offset.isdigit() else 0
+    threaded = request.environ.get("wsgi.multithread", False)
+
+    def stream(run: str | None, offset: int):
+        retry = PROGRESS_RETRY_MS if threaded else PROGRESS_SYNC_RETRY_MS
+        yield f"retry: {retry}\n\n"
+        deadline = time.monotonic() + (PROGRESS_STREAM_SECONDS if threaded else 0)
+        seen = None
+
+        while True:
+            try:
+                stat = os.stat(flows.RELEASE_LOG_FILE)
+                # Unchanged since the last look: nothing new to read.
+                changed = (stat.st_size, stat.st_mtime_ns) != seen
+                seen = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                changed = False
+
+            entries = []
+            if changed:
+                run, entries = flows.read_log(run, offset)
+
+            for offset, entry in entries:
+                data = json.dumps({**entry, "text": flows.format_entry(entry)})
+                yield f"id: {run}:{offset}\ndata: {data}\n\n"
+
+            if not entries and not flow_queue.pending():
+                yield "event: done\ndata: \n\n"
+                return
+
+            if time.monotonic() >= deadline:
+                return
+
+            time.sleep(PROGRESS_POLL_SECONDS)
+
+    return Response(
+        stream(run or None, offset),
+        mimetype="text/event-stream",
+        # nginx would otherwise hold events back until its buffer fills.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 def _release_creator(is_beta: bool):
-    form: VersionCreatorForm = VersionCreatorForm()
+    form: forms.VersionCreatorForm = forms.VersionCreatorForm()
 
     if request.method == "POST" and form.validate():
-        # Off the request thread: moving a column is one PATCH per ticket, which can
-        # outlast gunicorn's 30s worker timeout on a busy board.
-        thread = threading.Thread(
-            target=run_flows,
-            args=(
+        try:
+            flow_queue.submit(
                 is_beta,
                 form.version_number.data,
                 form.candidate_number.data if is_beta else None,
-                discord.fetch_user(),
-            ),
-        )
-        thread.start()
+                discord().fetch_user().username,
+            )
+        except DuplicateJob:
+            return (
+                render_template(
+                    "message.html",
+                    message="That flow has already been submitted.",
+                    status=409,
+                ),
+                409,
+            )
+
+        flow_queue.start(run_flows)
 
         if is_beta:
             msg = f"The board is being prepared for {form.version_number.data} Beta {form.candidate_number.data}. You will receive a notification when it is done."
@@ -269,17 +444,39 @@ def release_create():
 @app.route("/bugs")
 @scope_locked(team_only=True)
 def bug_list():
-    try:
-        with open(BUG_REPORT_FILE, "r") as f:
-            text = f.read()
-    except FileNotFoundError:
+    """The latest release's fixed bugs, or `?version=`'s. `?format=markdown` or
+    `json` return the report bare, for pasting into Discord or the forum, and
+    `?diff=1` compares it with the release before."""
+    version = request.args.get("version")
+    format = request.args.get("format", "html")
+    if format not in ("html", *report.FORMATS):
+        return Response(status=400, response=f"Unknown format {format}")
+
+    rendered_as = "text" if format == "html" else format
+    if request.args.get("diff"):
+        diff = report.diff_reports(version)
+        text = diff and report.render_diff(diff, rendered_as)
+    else:
+        text = report.render_report(version, rendered_as)
+
+    if text is None:
+        if format != "html":
+            return Response(status=404, response="No such bug report")
+
         # Written by the taiga flow of a release; absent until one has run.
         text = "No bug report has been generated yet."
 
+    if format != "html":
+        mimetype = {"text": "text/plain", "markdown": "text/markdown"}.get(
+            format, "application/json"
+        )
+        return Response(text, mimetype=mimetype)
+
     return (
         render_template(
             "message.html",
-            message="See the list of fixed bugs for the latest release here",
+            message="See the list of fixed bugs for "
+            f"{version or 'the latest release'} here",
             status=200,
             logs=text,
         ),
@@ -305,8 +502,10 @@ def patch_engine():
             503,
         )
 
+    # Only this route takes uploads this large.
+    request.max_content_length = patching.MAX_UPLOAD_BYTES
     patching.sweep()
-    form = PatcherForm()
+    form = forms.PatcherForm()
     error = None
 
     if form.validate_on_submit():
@@ -390,8 +589,68 @@ def patch_sagepatch(token: str, slug: str):
     return serve_patched(token, slug, sagepatch=True)
 
 
+def patch_gauges() -> dict:
+    # A worker that has not imported patching has not run a patch, and a health
+    # check should not be what loads pysage-tools.
+    if "patching" not in sys.modules:
+        return {"queued": 0, "running": 0, "workspaces": 0, "workspace_bytes": 0}
+
+    return patching.gauges()
+
+
+def rss_bytes() -> int | None:
+    """The process's resident memory now, rather than the peak getrusage gives."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+@app.route("/healthz")
+def healthz():
+    """For systemd and nginx to poll: answered from memory, without touching a
+    database or the disk. 503 while `PATCH_BUSY_QUEUE` patch runs are waiting,
+    though everything else is still served."""
+    patch = patch_gauges()
+    busy = patch["queued"] >= PATCH_BUSY_QUEUE
+    return (
+        {
+            "status": "busy" if busy else "ok",
+            "uptime": round(time.monotonic() - STARTED_AT),
+            "patch": patch,
+        },
+        503 if busy else 200,
+    )
+
+
+@app.route("/status")
+@scope_locked(team_only=True)
+def status():
+    """What this worker is doing, and the flows every worker shares."""
+    jobs = flow_queue.pending()
+    return {
+        "uptime": round(time.monotonic() - STARTED_AT),
+        "rss_bytes": rss_bytes(),
+        "flows": {
+            "running": next((job for job in jobs if job["state"] == "running"), None),
+            "queued": [job for job in jobs if job["state"] == "queued"],
+        },
+        "patch": patch_gauges(),
+        "relay": {
+            "backlog": default_relay.pending,
+            "sent": default_relay.sent,
+            "failed": default_relay.failed,
+            "duplicates": default_relay.duplicates,
+        },
+    }
+
+
 @app.errorhandler(RequestEntityTooLarge)
 def too_large(error):
+    if request.endpoint != "patch_engine":
+        return Response(status=413, response="Request too large")
+
     return (
         render_template(
             "message.html",
@@ -0,0 +1,45 @@
+"""The app as an ASGI application, for serving with uvicorn instead of sync gunicorn.
+
+    uvicorn asgi:app --uds edain-manager.sock
+
+Flask stays a WSGI app; the adapter below runs each request's view on a thread pool
+while the event loop does the socket work. A request body is read on the loop into
+a spooled file before the view starts, so a slow 128M upload to `/patch` occupies
+no thread while it trickles in, and a download or a webhook is not queued behind
+it. Patch runs themselves are bounded separately, see `patching.PATCH_WORKERS`.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import app as wsgi_app
+
+# Views running at once, as `--threads` is for gthread.
+ASGI_THREADS = 8
+
+_request_pool = ThreadPoolExecutor(
+    max_workers=ASGI_THREADS, thread_name_prefix="request"
+)
+
+
+class _Instance(WsgiToAsgiInstance):
+    # asgiref's own is a bare `@sync_to_async`, which is thread-sensitive: with no
+    # outer sync thread under uvicorn, every view then runs on one shared thread,
+    # and a download being streamed holds up every request behind it.
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.run_wsgi_app.__wrapped__,
+        thread_sensitive=False,
+        executor=_request_pool,
+    )
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _Instance(self.wsgi_application, self.duplicate_header_limit)(
+            scope, receive, send
+        )
+
+
+app = ThreadedWsgiToAsgi(wsgi_app)
@@ -0,0 +1,121 @@
+"""Time the release flows and the board tasks against the offline Taiga stand-in.
+
+Each flow runs on a fresh board of every size asked for, and the table shows its
+wall time beside the calls the client made - so a change to the client or a flow
+can be judged on both before it meets the real board.
+
+    python -m bench.flows
+    python -m bench.flows --sizes 100 1000 --latency 0.02 --output bench_output.txt
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from bench.standin import Board, scaled, serve, synthetic
+from flows import taiga_flow
+from taiga.attach_tickets import attach_tickets
+from taiga.auto_move_test import auto_move_test
+from taiga.config import PROJECT_ID
+from taiga.mirror import BoardMirror, MirroredClient
+from taiga.move_column import move_column
+from taiga.sorter import sort
+from taiga.utils import Client
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+FLOWS = {
+    "release": lambda client: taiga_flow(client, False, "9.9", None),
+    "beta": lambda client: taiga_flow(client, True, "9.9", "1"),
+    "move_column": lambda client: move_column(client, "in-test", "done"),
+    "sort": lambda client: sort(client),
+    "attach_tickets": lambda client: attach_tickets(client),
+    "auto_move_tested": lambda client: auto_move_test(client),
+}
+
+
+def run(name: str, snapshot: dict, *, latency: float, error_rate: float) -> dict:
+    board = Board(snapshot, latency=latency, error_rate=error_rate, seed=0)
+    url, server = serve(board)
+    try:
+        kwargs = dict(base_url=url, project_id=PROJECT_ID, token_cache=None)
+        if name == "sort":
+            client = MirroredClient(**kwargs, mirror=BoardMirror("board.sqlite3"))
+        else:
+            client = Client(**kwargs)
+        client.auth()
+
+        started = time.perf_counter()
+        FLOWS[name](client)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+
+    return {
+        "flow": name,
+        "stories": len(snapshot["stories"]),
+        "seconds": round(elapsed, 3),
+        "calls": sum(board.calls.values()),
+        "summary": client.session.metrics.summary(),
+    }
+
+
+def bench(args, recorded: dict | None, results: list):
+    for size in args.sizes:
+        snapshot = scaled(recorded, size) if recorded else synthetic(size)
+        for name in args.flows:
+            for leftover in ("board.sqlite3", "board.sqlite3-wal"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+            result = run(
+                name, snapshot, latency=args.latency, error_rate=args.error_rate
+            )
+            results.append(result)
+            print(
+                f"{result['flow']:<18} {result['stories']:>6} stories"
+                f" {result['seconds']:>9.3f}s {result['calls']:>6} calls"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark flows on the stand-in.")
+    parser.add_argument("--snapshot", help="Recorded board to scale; else synthetic.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--flows", nargs="+", choices=sorted(FLOWS), default=FLOWS)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="Also write the results here, as JSON.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # The stand-in's request log would drown the table.
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    recorded = None
+    if args.snapshot:
+        with open(args.snapshot) as f:
+            recorded = json.load(f)
+
+    results = []
+    output = os.path.abspath(args.output) if args.output else None
+    # The flows write their report, release_log.txt and the mirror into the working
+    # directory; none of that belongs in the checkout.
+    checkout = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            bench(args, recorded, results)
+        finally:
+            os.chdir(checkout)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+"""Load-test the web app's routes with a mix of traffic, on each serving mode.
+
+Each serving mode is started in turn: `sync` is one request at a time, as a single
+sync gunicorn worker serves; `threaded` takes a thread per request; `asgi` is
+`asgi.py` under uvicorn, when uvicorn and asgiref are installed; `test` drives the
+app in-process through Flask's test client, which measures the app alone.
+
+Clients pick routes by the mix's weights for the whole run: bursts of Taiga webhook
+events for one story, `/bugs` views of seeded reports, patch submissions and
+downloads of what they produced. Meanwhile slow clients trickle a `game.dat`
+upload in, which is what shows one request waiting behind another. Each route's
+throughput, latency percentiles and error rate (5xx or no answer) are printed and
+saved under `bench/results`, and `--compare` sets a run beside an earlier one.
+
+Discord is a local stub and the team pages' sign-in is bypassed as `DEBUG` does.
+None of these routes asks Taiga anything - the webhook only updates the local board
+mirror - so nothing leaves the machine.
+
+Patching needs pysage-tools and a real binary, which `--game-dat` gives. Without
+one the synthetic upload fails the patches' byte checks, and the rows say what was
+measured instead: `patch-rejected` is the upload and the refused run, and
+`download-404` asks for an expired file.
+
+    python -m bench.load
+    python -m bench.load --servers sync threaded --duration 20 --uploads 2
+    python -m bench.load --mix webhooks --servers threaded --clients 8 --burst 10
+    python -m bench.load --compare bench/results/<earlier run>.json
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import random
+import re
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from flask import Flask
+from werkzeug.serving import make_server
+
+SERVERS = ("sync", "threaded", "asgi", "test")
+RESULTS_DIR = os.path.join("bench", "results")
+
+# Relative weights of the routes each client picks from.
+MIXES = {
+    "light": {"webhook": 1, "bugs": 1, "download": 1},
+    "browse": {"bugs": 4, "webhook": 3, "download": 2, "patch": 1},
+    "webhooks": {"webhook": 1},
+    "patch": {"patch": 3, "download": 3, "bugs": 1},
+}
+
+BUG_PAGES = ("/bugs", "/bugs?format=markdown", "/bugs?diff=1")
+EXPIRED_DOWNLOAD = "/patch/download/expired-token-0000/game-dat"
+DOWNLOAD_LINK = re.compile(r"/patch/download/[A-Za-z0-9_-]+/[a-z0-9-]+")
+COMMENT_HTML = "<p>Still happens after the last beta:</p>" + (
+    "<ul><li><strong>Steps</strong>: build a <em>fortress</em>, then "
+    "<a href='http://localhost'>upgrade it</a></li></ul>" * 20
+)
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+
+    if len(samples) == 1:
+        return {"p50": samples[0], "p95": samples[0], "p99": samples[0]}
+
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def discord_stub() -> tuple[str, object]:
+    stub = Flask("discord")
+    stub.add_url_rule("/webhook", "webhook", lambda: ("", 204), methods=["POST"])
+    server = make_server("127.0.0.1", 0, stub, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.port}/webhook", server
+
+
+def start_server(mode: str, wsgi_app) -> tuple[str, callable]:
+    """Serve `wsgi_app` in `mode` from a background thread; returns the base URL and
+    a function that stops it."""
+    if mode == "asgi":
+        import uvicorn
+
+        from asgi import app as asgi_app
+
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        server = uvicorn.Server(uvicorn.Config(asgi_app, log_level="warning"))
+        thread = threading.Thread(
+            target=server.run, kwargs={"sockets": [sock]}, daemon=True
+        )
+        thread.start()
+        while not server.started:
+            time.sleep(0.01)
+
+        def stop():
+            server.should_exit = True
+            thread.join()
+
+        return f"http://127.0.0.1:{sock.getsockname()[1]}", stop
+
+    server = make_server("127.0.0.1", 0, wsgi_app, threaded=mode == "threaded")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.port}", server.shutdown
+
+
+def http_sender(base: str):
+    url = urllib.parse.urlsplit(base)
+
+    def send(method: str, path: str, body: bytes | None, headers: dict):
+        connection = http.client.HTTPConnection(url.hostname, url.port, timeout=120)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    return send
+
+
+def test_sender(wsgi_app):
+    client = wsgi_app.test_client()
+
+    def send(method: str, path: str, body: bytes | None, headers: dict):
+        response = client.open(path, method=method, data=body, headers=headers)
+        return response.status_code, response.get_data()
+
+    return send
+
+
+def multipart(files: dict, fields: dict = None) -> tuple[bytes, str]:
+    """A form body with `files` ({field: (filename, content)}) and `fields`."""
+    boundary = "loadtestboundary"
+    parts = []
+    for name, value in (fields or {}).items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n".encode()
+        )
+    for name, (filename, content) in files.items():
+        parts.append(
+            (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode()
+            + content
+            + b"\r\n"
+        )
+
+    body = b"".join(parts) + f"--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def synthetic_binary(size: int) -> bytes:
+    # Starts as a Windows executable does, which is all the patcher checks before
+    # patching.
+    return b"MZ" + os.urandom(min(size, 1 << 16)) * (size // (1 << 16) + 1)
+
+
+def slow_upload(base: str, size: int, seconds: float):
+    """POST a `size`-byte upload to `/patch`, spread over `seconds`."""
+    body, content_type = multipart({"game.dat": ("game.dat", synthetic_binary(size))})
+    url = urllib.parse.urlsplit(base)
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+    try:
+        connection.putrequest("POST", "/patch")
+        connection.putheader("Content-Type", content_type)
+        connection.putheader("Content-Length", str(len(body)))
+        connection.endheaders()
+
+        chunk = max(1, len(body) // 100)
+        for start in range(0, len(body), chunk):
+            connection.send(body[start : start + chunk])
+            time.sleep(seconds / 100)
+
+        connection.getresponse().read()
+    except OSError:
+        # A server that answers before the body is in may close on the rest.
+        pass
+    finally:
+        connection.close()
+
+
+def seed_reports(stories: int):
+    """Two releases' bug reports, the later one fixing most of the earlier's bugs
+    and some more, so `/bugs` and its diff have something to render."""
+    import report
+
+    bugs = [{"ref": n, "subject": f"Bug {n}: *units* stuck"} for n in range(stories)]
+    report.save_report("1.0", bugs[: stories // 2])
+    report.save_report("1.1", bugs[stories // 4 :])
+
+
+def patch_form(game_dat: bytes) -> tuple[bytes, str] | None:
+    """A submission of the first engine patch that takes no parameters, or None
+    when there is nothing to patch with."""
+    import patching
+
+    for target in patching.TARGETS:
+        for spec in target.specs:
+            if target.engine and not spec.params and not spec.experimental:
+                return multipart(
+                    {target.field: (target.name, game_dat)},
+                    {spec.field: "y", "credit_agreement": "y"},
+                )
+
+    return None
+
+
+class Client:
+    """One simulated visitor, sending requests picked from the mix until stopped."""
+
+    def __init__(self, send, routes: dict, args, secret: str, shared: dict, seed: int):
+        self.send = send
+        self.routes = routes
+        self.args = args
+        self.secret = secret
+        # The patch form body, whether it can succeed, and the download links the
+        # patch runs produced.
+        self.shared = shared
+        self.random = random.Random(seed)
+        self.samples = {}
+
+    def request(self, route: str, method: str, path: str, body=None, headers=None):
+        started = time.perf_counter()
+        try:
+            status, content = self.send(method, path, body, headers or {})
+        except OSError:
+            status, content = None, b""
+
+        error = status is None or status >= 500
+        self.samples.setdefault(route, []).append(
+            (time.perf_counter() - started, error)
+        )
+        return content
+
+    def webhook_burst(self):
+        # A story created and then commented on a few times in a row, as Taiga
+        # delivers an edit session.
+        story = self.random.randrange(1 << 30)
+        for n in range(self.args.burst):
+            event = {
+                "action": "create" if n == 0 else "change",
+                "type": "userstory",
+                # Unique, or the dedup index would answer most of them.
+                "date": f"load-{story}-{n}",
+                "by": {"id": 1, "username": "load", "photo": None},
+                "data": {
+                    "id": story,
+                    "subject": f"Story {story}",
+                    "permalink": "http://localhost",
+                    "tags": ["load"],
+                },
+                "change": {
+                    "comment": "Still happens",
+                    "comment_html": COMMENT_HTML,
+                    "delete_comment_date": None,
+                    "edit_comment_date": None,
+                },
+            }
+            self.request(
+                "webhook",
+                "POST",
+                f"/webhook/{self.secret}",
+                json.dumps(event).encode(),
+                {"Content-Type": "application/json"},
+            )
+
+    def patch(self):
+        body, content_type = self.shared["patch_form"]
+        route = "patch" if self.shared["patchable"] else "patch-rejected"
+        content = self.request(
+            route, "POST", "/patch", body, {"Content-Type": content_type}
+        )
+        if link := DOWNLOAD_LINK.search(content.decode(errors="replace")):
+            with self.shared["lock"]:
+                self.shared["links"].append(link.group(0))
+
+    def download(self):
+        with self.shared["lock"]:
+            links = self.shared["links"][-20:]
+
+        if links:
+            self.request("download", "GET", self.random.choice(links))
+        else:
+            self.request("download-404", "GET", EXPIRED_DOWNLOAD)
+
+    def run(self, stop: threading.Event):
+        names = list(self.routes)
+        weights = [self.routes[name] for name in names]
+        while not stop.is_set():
+            route = self.random.choices(names, weights)[0]
+            if route == "webhook":
+                self.webhook_burst()
+            elif route == "patch":
+                self.patch()
+            elif route == "download":
+                self.download()
+            else:
+                self.request("bugs", "GET", self.random.choice(BUG_PAGES))
+
+            if self.args.think:
+                time.sleep(self.random.expovariate(1 / self.args.think))
+
+
+def summarise(samples: dict, duration: float) -> dict:
+    results = {}
+    for route, timings in sorted(samples.items()):
+        latencies = [seconds * 1000 for seconds, _ in timings]
+        errors = sum(error for _, error in timings)
+        results[route] = {
+            "requests": len(timings),
+            "per_second": len(timings) / duration,
+            "error_rate": errors / len(timings),
+            **percentiles(latencies),
+        }
+
+    return results
+
+
+def run(mode: str, args, web, routes: dict, shared: dict) -> dict:
+    if mode == "test":
+        # The test client keeps a cookie jar, so one per visitor; and there is no
+        # socket for a slow upload to trickle into.
+        def sender():
+            return test_sender(web.app)
+
+        url, stop_server, uploaders = None, lambda: None, 0
+    else:
+        url, stop_server = start_server(mode, web.app)
+        send = http_sender(url)
+        uploaders = args.uploads
+
+        def sender():
+            return send
+
+    shared["links"] = []
+    clients = [
+        Client(sender(), routes, args, web.TAIGA_URL_SECRET, shared, seed=args.seed + n)
+        for n in range(args.clients)
+    ]
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=slow_upload, args=(url, args.upload_size, args.duration * 0.8)
+        )
+        for _ in range(uploaders)
+    ] + [threading.Thread(target=client.run, args=(stop,)) for client in clients]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    stop_server()
+
+    samples = {}
+    for client in clients:
+        for route, timings in client.samples.items():
+            samples.setdefault(route, []).extend(timings)
+
+    return summarise(samples, duration)
+
+
+def print_row(server: str, route: str, result: dict):
+    print(
+        f"{server:<10} {route:<15} {result['requests']:>8}"
+        f" {result['per_second']:>8.1f} {result['error_rate']:>7.1%}"
+        f" {result['p50']:>9.1f} {result['p95']:>9.1f} {result['p99']:>9.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the web app's routes.")
+    parser.add_argument("--servers", nargs="+", choices=SERVERS, default=SERVERS[:3])
+    parser.add_argument("--mix", choices=MIXES, default="light")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument(
+        "--think", type=float, default=0.0, help="Mean pause between requests."
+    )
+    parser.add_argument("--burst", type=int, default=1, help="Events per webhook.")
+    parser.add_argument("--uploads", type=int, default=2, help="Slow uploaders.")
+    parser.add_argument("--upload-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--game-dat", help="A real game.dat to patch.")
+    parser.add_argument("--stories", type=int, default=500, help="Bugs per report.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", help="An earlier run's results file.")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    if args.game_dat:
+        with open(args.game_dat, "rb") as f:
+            game_dat = f.read()
+    else:
+        game_dat = synthetic_binary(args.upload_size)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["servers"]
+
+    results = {}
+    discord_url, discord = discord_stub()
+    checkout = os.getcwd()
+    # The app is imported from the checkout, but its databases, the relay's outbox
+    # and the seeded reports go into a scratch directory.
+    sys.path.insert(0, checkout)
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            import app as web
+            import patching
+
+            web.DEBUG = True
+            web.TAIGA_WEBHOOK = discord_url
+            # The form is posted without a page to take the CSRF token from.
+            web.app.config["WTF_CSRF_ENABLED"] = False
+            seed_reports(args.stories)
+
+            routes = dict(MIXES[args.mix])
+            shared = {"lock": threading.Lock(), "patchable": bool(args.game_dat)}
+            if "patch" in routes:
+                shared["patch_form"] = patching.AVAILABLE and patch_form(game_dat)
+                if not shared["patch_form"]:
+                    print("patch skipped: pysage-tools has no patch to submit here")
+                    del routes["patch"]
+
+            print(
+                f"{'server':<10} {'route':<15} {'requests':>8} {'req/s':>8}"
+                f" {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+            )
+            for mode in args.servers:
+                if mode == "asgi":
+                    try:
+                        import asgiref, uvicorn  # noqa: F401
+                    except ImportError:
+                        print(
+                            f"{mode:<10} skipped: uvicorn and asgiref are not installed"
+                        )
+                        continue
+
+                results[mode] = run(mode, args, web, routes, shared)
+                for route, result in results[mode].items():
+                    print_row(mode, route, result)
+                    if before := baseline.get(mode, {}).get(route):
+                        print_row("  before", "", before)
+        finally:
+            os.chdir(checkout)
+            discord.shutdown()
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"{stamp}-{args.mix}.json")
+        with open(path, "w") as f:
+            json.dump({"args": vars(args), "servers": results}, f, indent=2)
+        print(f"Saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
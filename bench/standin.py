@@ -0,0 +1,492 @@
+"""A local stand-in for the parts of Taiga's API that `taiga.utils.Client` calls.
+
+It exists so that `taiga_flow`, `move_column` and the `cli.py` tasks can be run -
+and timed - without the real board: the stand-in is seeded from a snapshot of the
+board (see `record`) or from a synthetic one of any size, and can add latency and
+inject 429s or 5xxs to see how the client copes.
+
+It imitates the behaviour the client depends on rather than all of Taiga: version
+checks on PATCH, pagination headers, `modified_date__gte`, the tag filter matching
+every tag, the kanban bulk endpoint answering with what it moved, and an epic
+refusing a story it is already related to.
+
+    python -m bench.standin record snapshot.json
+    python -m bench.standin serve --snapshot snapshot.json --stories 1000 --latency 0.05
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+from taiga.config import EPIC_STATUS_MAPPING, STATUS_MAPPING
+from taiga.utils import Client, status_mappings
+
+#: The custom attribute `auto_move_test` reads: the "tested" checkbox.
+TESTED_ATTRIBUTE = 44202
+DEFAULT_PAGE_SIZE = 30
+TAG_COLORS = ["#A9AABC", "#E44057", "#5178D3", "#70728F", "#4C566A"]
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class Board:
+    """The board's state, and the faults to inject while serving it."""
+
+    def __init__(
+        self,
+        snapshot: dict,
+        *,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        seed: int = None,
+    ):
+        snapshot = copy.deepcopy(snapshot)
+        self.stories = {story["id"]: story for story in snapshot["stories"]}
+        self.epics = {epic["id"]: epic for epic in snapshot["epics"]}
+        self.statuses = snapshot["statuses"]
+        self.attributes = {int(k): v for k, v in snapshot["attributes"].items()}
+        self.history = {int(k): v for k, v in snapshot["history"].items()}
+        self.tags = dict(snapshot.get("tags", {}))
+        self.related = []
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+
+        self.tokens = set()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def next_id(self, objects: dict) -> int:
+        return max(objects, default=0) + 1
+
+
+def synthetic(stories: int, *, seed: int = 0) -> dict:
+    """A board of `stories` tickets spread over the configured columns, with the
+    epics, tested checkboxes and history the flows look for."""
+    rng = random.Random(seed)
+    statuses = [
+        {"id": status_id, "slug": slug, "name": slug.replace("-", " ").title()}
+        for slug, status_id in STATUS_MAPPING.items()
+    ]
+    tags = ["release", "beta", "balance", "crash", "ai", "visual", "map"]
+
+    board = {
+        "stories": [],
+        "epics": [],
+        "statuses": statuses,
+        "attributes": {},
+        "history": {},
+        "tags": {tag: TAG_COLORS[i % len(TAG_COLORS)] for i, tag in enumerate(tags)},
+    }
+
+    for story_id in range(1, stories + 1):
+        status = rng.choice(statuses)
+        picked = rng.sample(tags, rng.randint(0, 2))
+        board["stories"].append(
+            {
+                "id": story_id,
+                "ref": story_id,
+                "subject": f"Synthetic bug #{story_id}",
+                "status": status["id"],
+                "status_extra_info": {"name": status["name"]},
+                "version": 1,
+                "kanban_order": rng.randint(0, stories * 10),
+                "tags": [[tag, board["tags"][tag]] for tag in picked],
+                "modified_date": _now(),
+            }
+        )
+
+        tested = status["slug"] == "in-test" and rng.random() < 0.5
+        board["attributes"][story_id] = {
+            "attributes_values": {str(TESTED_ATTRIBUTE): tested},
+            "version": 1,
+        }
+        board["history"][story_id] = [
+            {
+                "id": f"{story_id}-{entry}",
+                "user": {"name": rng.choice(["Ulmo", "Osse", "Uinen"])},
+                "diff": {"status": [1, 2]},
+                "created_at": _now(),
+            }
+            for entry in range(rng.randint(1, 8))
+        ]
+        if tested:
+            board["history"][story_id].insert(
+                0,
+                {
+                    "id": f"{story_id}-tested",
+                    "user": {"name": "Tester"},
+                    "diff": {
+                        "custom_attributes": [
+                            [],
+                            [{"id": TESTED_ATTRIBUTE, "value": True}],
+                        ]
+                    },
+                    "created_at": _now(),
+                },
+            )
+
+    for index, (tag, name) in enumerate(
+        [("release", "Current"), ("beta", "Current"), ("release", "Old")]
+    ):
+        board["epics"].append(
+            {
+                "id": index + 1,
+                "subject": f"4.{index} {tag.title()} Bugs",
+                "status": EPIC_STATUS_MAPPING.get(name.lower()),
+                "status_extra_info": {"name": name},
+                "version": 1,
+                "epics_order": index,
+            }
+        )
+
+    return board
+
+
+def scaled(snapshot: dict, stories: int, *, seed: int = 0) -> dict:
+    """`snapshot` resized to `stories` tickets, cloning the recorded ones - so a board
+    of 10,000 keeps the mix of columns, tags and histories of the real one."""
+    rng = random.Random(seed)
+    recorded = snapshot["stories"]
+    # Keyed by string whether the snapshot came from JSON or from `synthetic`.
+    attributes = {str(k): v for k, v in snapshot["attributes"].items()}
+    history = {str(k): v for k, v in snapshot["history"].items()}
+    board = copy.deepcopy(snapshot)
+    board["stories"], board["attributes"], board["history"] = [], {}, {}
+
+    for story_id in range(1, stories + 1):
+        template = recorded[(story_id - 1) % len(recorded)]
+        story = copy.deepcopy(template)
+        story.update(
+            id=story_id,
+            ref=story_id,
+            version=1,
+            kanban_order=rng.randint(0, stories * 10),
+        )
+        board["stories"].append(story)
+
+        source = str(template["id"])
+        board["attributes"][story_id] = copy.deepcopy(
+            attributes.get(source, {"attributes_values": {}, "version": 1})
+        )
+        board["history"][story_id] = copy.deepcopy(history.get(source, []))
+
+    return board
+
+
+def record(path: str):
+    """Write a snapshot of the real board to `path`, for the stand-in to replay.
+
+    Custom attribute values and history are only recorded for the in-test column,
+    which is all `auto_move_test` reads; recording them for every story would cost
+    two calls per ticket on the real board."""
+    client = Client()
+    client.auth()
+
+    stories = client.list_stories()
+    in_test = [s for s in stories if s["status"] == status_mappings.get("in-test")]
+    snapshot = {
+        "stories": stories,
+        "epics": client.list_epics(),
+        "statuses": client.list_statuses(),
+        "attributes": {s["id"]: client.get_story_attributes(s["id"]) for s in in_test},
+        "history": {s["id"]: client.get_issue_history(s["id"]) for s in in_test},
+        "tags": {tag[0]: tag[1] for s in stories for tag in s["tags"] or []},
+    }
+
+    with open(path, "w") as f:
+        json.dump(snapshot, f)
+
+    logging.info("Recorded %d stories to %s", len(stories), path)
+
+
+def create_app(board: Board) -> Flask:
+    app = Flask(__name__)
+    api = "/api/v1"
+
+    @app.before_request
+    def inject():
+        board.calls[f"{request.method} {request.url_rule}"] += 1
+        if board.latency:
+            time.sleep(board.latency)
+
+        if board.error_rate and board.random.random() < board.error_rate:
+            headers = {"Retry-After": "1"} if board.error_status == 429 else {}
+            return jsonify(detail="Injected failure"), board.error_status, headers
+
+        if request.path.startswith(f"{api}/auth"):
+            return None
+
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if token not in board.tokens:
+            return jsonify(detail="Invalid token"), 401
+
+    def issue_token():
+        token = secrets.token_hex(8)
+        board.tokens.add(token)
+        return jsonify(auth_token=token, refresh=secrets.token_hex(8))
+
+    @app.post(f"{api}/auth")
+    def auth():
+        return issue_token()
+
+    @app.post(f"{api}/auth/refresh")
+    def refresh():
+        return issue_token()
+
+    def paginated(objects: list) -> Response:
+        if request.headers.get("x-disable-pagination"):
+            return jsonify(objects)
+
+        page = int(request.args.get("page", 1))
+        size = int(request.args.get("page_size", DEFAULT_PAGE_SIZE))
+        response = jsonify(objects[(page - 1) * size : page * size])
+        response.headers["x-paginated"] = "true"
+        response.headers["x-paginated-by"] = str(size)
+        response.headers["x-pagination-count"] = str(len(objects))
+        response.headers["x-pagination-current"] = str(page)
+        if page * size < len(objects):
+            args = request.args.to_dict()
+            args["page"] = page + 1
+            query = "&".join(f"{key}={value}" for key, value in args.items())
+            response.headers["x-pagination-next"] = f"{request.base_url}?{query}"
+
+        return response
+
+    @app.get(f"{api}/userstories")
+    def list_stories():
+        stories = list(board.stories.values())
+        if "status" in request.args:
+            stories = [s for s in stories if s["status"] == int(request.args["status"])]
+
+        for tag in filter(None, request.args.get("tags", "").split(",")):
+            stories = [s for s in stories if tag in (t[0] for t in s["tags"])]
+
+        if "modified_date__gte" in request.args:
+            since = request.args["modified_date__gte"]
+            stories = [s for s in stories if s["modified_date"] >= since]
+
+        stories.sort(key=lambda s: (s["kanban_order"], s["id"]))
+        return paginated(stories)
+
+    def conflict(obj: dict):
+        if request.json.get("version") != obj["version"]:
+            return jsonify(version="The version doesn't match with the current one")
+
+    @app.get(f"{api}/userstories/<int:story_id>")
+    def get_story(story_id: int):
+        return jsonify(board.stories[story_id])
+
+    @app.patch(f"{api}/userstories/<int:story_id>")
+    def update_story(story_id: int):
+        with board.lock:
+            story = board.stories[story_id]
+            if error := conflict(story):
+                return error, 400
+
+            data = request.json
+            if "status" in data:
+                story["status"] = data["status"]
+
+            if "tags" in data:
+                story["tags"] = [[tag, board.tags.get(tag)] for tag in data["tags"]]
+
+            if "comment" in data:
+                board.history.setdefault(story_id, []).insert(
+                    0,
+                    {
+                        "id": secrets.token_hex(4),
+                        "user": {"name": "Edain Manager"},
+                        "diff": {},
+                        "comment": data["comment"],
+                        "created_at": _now(),
+                    },
+                )
+
+            story["version"] += 1
+            story["modified_date"] = _now()
+            return jsonify(story)
+
+    @app.post(f"{api}/userstories/bulk_update_kanban_order")
+    def bulk_order():
+        data = request.json
+        moved = []
+        with board.lock:
+            for order, story_id in enumerate(data["bulk_userstories"]):
+                story = board.stories.get(story_id)
+                if story is None:
+                    continue
+
+                # A bulk update in Taiga, as here: the modified date stays put, so
+                # an incremental sync does not see the move.
+                story.update(
+                    status=data["status_id"],
+                    kanban_order=order,
+                    version=story["version"] + 1,
+                )
+                moved.append(
+                    {"id": story_id, "status": story["status"], "kanban_order": order}
+                )
+
+        return jsonify(moved)
+
+    @app.get(f"{api}/userstories/custom-attributes-values/<int:story_id>")
+    def story_attributes(story_id: int):
+        return jsonify(
+            board.attributes.get(story_id, {"attributes_values": {}, "version": 1})
+        )
+
+    @app.get(f"{api}/userstory-statuses")
+    def statuses():
+        return jsonify(board.statuses)
+
+    @app.get(f"{api}/history/userstory/<int:story_id>")
+    def history(story_id: int):
+        return paginated(board.history.get(story_id, []))
+
+    @app.get(f"{api}/epics")
+    def list_epics():
+        return paginated(list(board.epics.values()))
+
+    @app.post(f"{api}/epics")
+    def create_epic():
+        data = request.form
+        with board.lock:
+            epic_id = board.next_id(board.epics)
+            status = int(data["status"]) if "status" in data else None
+            name = next(
+                (k for k, v in EPIC_STATUS_MAPPING.items() if v == status), "new"
+            )
+            board.epics[epic_id] = {
+                "id": epic_id,
+                "subject": data["subject"],
+                "status": status,
+                "status_extra_info": {"name": name.title()},
+                "version": 1,
+                "epics_order": int(data.get("epics_order", 1)),
+            }
+
+        return jsonify(board.epics[epic_id]), 201
+
+    @app.patch(f"{api}/epics/<int:epic_id>")
+    def update_epic(epic_id: int):
+        with board.lock:
+            epic = board.epics[epic_id]
+            if error := conflict(epic):
+                return error, 400
+
+            data = request.json
+            if "status" in data:
+                name = next(
+                    (k for k, v in EPIC_STATUS_MAPPING.items() if v == data["status"]),
+                    "old",
+                )
+                epic.update(
+                    status=data["status"], status_extra_info={"name": name.title()}
+                )
+
+            if "epics_order" in data:
+                epic["epics_order"] = data["epics_order"]
+
+            epic["version"] += 1
+            return jsonify(epic)
+
+    @app.post(f"{api}/epics/<int:epic_id>/related_userstories")
+    def attach(epic_id: int):
+        user_story = int(request.form["user_story"])
+        with board.lock:
+            if (epic_id, user_story) in board.related:
+                error = ["The relation between epic and story already exists"]
+                return jsonify(non_field_errors=error), 400
+
+            board.related.append((epic_id, user_story))
+            epic = board.epics[epic_id]
+            board.stories[user_story].setdefault("epics", []).append(
+                {"id": epic["id"], "subject": epic["subject"]}
+            )
+
+        return jsonify(epic=epic_id, user_story=user_story), 201
+
+    @app.post(f"{api}/projects/<int:project_id>/create_tag")
+    def create_tag(project_id: int):
+        with board.lock:
+            board.tags[request.form["tag"]] = request.form["color"]
+
+        return jsonify(board.tags)
+
+    return app
+
+
+def serve(board: Board, port: int = 0):
+    """Serve `board` from a background thread; returns the API's base URL and the
+    server, to `shutdown()` when done."""
+    server = make_server("127.0.0.1", port, create_app(board), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.port}/api/v1", server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline Taiga stand-in.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    recorder = commands.add_parser("record", help="Snapshot the real board.")
+    recorder.add_argument("path")
+
+    server = commands.add_parser("serve", help="Serve a snapshot or synthetic board.")
+    server.add_argument("--snapshot", help="Recorded board; synthetic if omitted.")
+    server.add_argument("--stories", type=int, help="Resize the board to this many.")
+    server.add_argument("--latency", type=float, default=0.0, help="Seconds per call.")
+    server.add_argument("--error-rate", type=float, default=0.0)
+    server.add_argument("--error-status", type=int, default=503)
+    server.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)-8s %(message)s",
+    )
+
+    if args.command == "record":
+        record(args.path)
+        return
+
+    if args.snapshot:
+        with open(args.snapshot) as f:
+            snapshot = json.load(f)
+
+        if args.stories:
+            snapshot = scaled(snapshot, args.stories)
+    else:
+        snapshot = synthetic(args.stories or 1000)
+
+    board = Board(
+        snapshot,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    url, server = serve(board, args.port)
+    logging.info("Serving %d stories at %s", len(board.stories), url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Time importing the app, `cli.py` and each board script, and the memory that costs.
+
+Every module is imported in a fresh interpreter, a few times over, and the table
+shows the median import time and the process's peak RSS after it - what a gunicorn
+restart or a `cli.py` run on the Pi pays before doing anything. With `--baseline`,
+a module that got slower or larger than the saved run by more than `--tolerance`
+is flagged and the exit status is 1.
+
+    python -m bench.startup --output startup.json
+    python -m bench.startup --baseline startup.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+MODULES = (
+    "app",
+    "cli",
+    "flows",
+    "taiga.attach_tickets",
+    "taiga.auto_move_test",
+    "taiga.create_new_version",
+    "taiga.mirror",
+    "taiga.move_column",
+    "taiga.sorter",
+)
+
+# Run in the child: the import alone, timed from inside so interpreter start-up is
+# not counted, then peak RSS (kilobytes on Linux).
+PROBE = """
+import importlib, json, resource, sys, time
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - started
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"seconds": elapsed, "rss_kb": rss}))
+"""
+
+
+def measure(module: str, checkout: str, workdir: str, repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        # Outside the checkout, so the databases the app opens on import land in
+        # the scratch directory.
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE, module],
+            cwd=workdir,
+            env={**os.environ, "PYTHONPATH": checkout},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    return {
+        "module": module,
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "rss_kb": statistics.median(run["rss_kb"] for run in runs),
+    }
+
+
+def regressions(results: list, baseline: list, tolerance: float) -> list:
+    before = {result["module"]: result for result in baseline}
+    flagged = []
+    for result in results:
+        old = before.get(result["module"])
+        if old is None:
+            continue
+
+        for key in ("seconds", "rss_kb"):
+            if result[key] > old[key] * (1 + tolerance):
+                flagged.append(
+                    f"{result['module']}: {key} {old[key]:.4g} -> {result[key]:.4g}"
+                )
+
+    return flagged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark import time and RSS.")
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the results here, as JSON.")
+    parser.add_argument("--baseline", help="Compare with results saved earlier.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Growth over the baseline that counts as a regression.",
+    )
+    args = parser.parse_args()
+
+    checkout = os.getcwd()
+    results = []
+    print(f"{'module':<26} {'import ms':>10} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for module in args.modules:
+            result = measure(module, checkout, workdir, args.repeat)
+            results.append(result)
+            print(
+                f"{module:<26} {result['seconds'] * 1000:>10.1f}"
+                f" {result['rss_kb'] / 1024:>12.1f}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            flagged = regressions(results, json.load(f), args.tolerance)
+
+        for line in flagged:
+            print(f"Regression: {line}")
+
+        if flagged:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
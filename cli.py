@@ -1,20 +1,96 @@
 import argparse
+import datetime
 import logging
 
+from flows import Journal, plan_flow, run_flows, version_name
+from jobs import DuplicateJob, FlowQueue
+from relay import default_relay
 from taiga.attach_tickets import attach_tickets
 from taiga.auto_move_test import auto_move_test
+from taiga.mirror import sync
 from taiga.sorter import sort
+from taiga.utils import Client
+
+
+def jobs():
+    """Print the flow queue, newest first."""
+    for job in FlowQueue().history():
+        submitted = datetime.datetime.fromtimestamp(job["submitted_at"])
+        name = version_name(bool(job["is_beta"]), job["version"], job["candidate"])
+        print(
+            f"{job['id']:>4}  {submitted:%Y-%m-%d %H:%M}  {job['state']:<8}"
+            f" {name:<20} {job['ordered_by']}"
+            f"{'  ' + job['error'] if job['error'] else ''}"
+        )
+
 
 function_mapping = {
     "sort": sort,
     "attach_tickets": attach_tickets,
     "auto_move_tested": auto_move_test,
+    "sync": sync,
+    "jobs": jobs,
 }
 
+# The same flows as the /release and /beta pages.
+flow_commands = ["beta", "release"]
+
+
+def flow(args: argparse.Namespace):
+    is_beta = args.command == "beta"
+    if not args.version or (is_beta and not args.candidate):
+        raise SystemExit(
+            f"{args.command} needs --version{' and --candidate' if is_beta else ''}"
+        )
+
+    if not args.dry_run:
+        queue = FlowQueue()
+        try:
+            job_id = queue.submit(
+                is_beta, args.version, args.candidate if is_beta else None, "cli.py"
+            )
+        except DuplicateJob as e:
+            raise SystemExit(str(e))
+
+        # Run here unless another process is already running a flow, in which case
+        # that one picks this up once it is done.
+        queue.drain(run_flows)
+        # The relay's worker thread would die with this process.
+        default_relay.flush()
+        job = next(job for job in queue.history() if job["id"] == job_id)
+        print(
+            f"Flow {job_id}: {job['state']}{' - ' + job['error'] if job['error'] else ''}"
+        )
+        return
+
+    # Reads only: the plan is built from the board and printed, and nothing is sent.
+    # An unfinished run is shown as the re-run would resume it.
+    journal = Journal(is_beta, args.version, args.candidate)
+    plan = journal.plan
+    if plan is None:
+        client = Client()
+        client.auth()
+        plan = plan_flow(client, is_beta, args.version, args.candidate)
+    else:
+        print(
+            f"Resuming {journal.path}: {len(journal.moved)} of {len(plan.stories)}"
+            " ticket(s) already moved"
+        )
+
+    print("\n".join(plan.describe()))
+    print(plan.to_json())
+
 
 def main():
     parser = argparse.ArgumentParser(description="Edain Taiga board maintenance tasks.")
-    parser.add_argument("command", choices=sorted(function_mapping))
+    parser.add_argument("command", choices=sorted(function_mapping) + flow_commands)
+    parser.add_argument("--version", help="Version number, for release and beta.")
+    parser.add_argument("--candidate", help="Beta number, for beta.")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="For release and beta: show the plan and touch nothing.",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -22,7 +98,10 @@ def main():
         format="%(asctime)s %(levelname)-8s %(message)s",
     )
 
-    function_mapping[args.command]()
+    if args.command in flow_commands:
+        flow(args)
+    else:
+        function_mapping[args.command]()
 
 
 if __name__ == "__main__":
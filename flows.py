@@ -1,91 +1,308 @@
 import datetime
+import json
 import logging
+import math
 import pathlib
 import threading
 import traceback
+import uuid
+from dataclasses import asdict, dataclass, field
 
-import requests
-from flask_discord.models import User
-
+from relay import default_relay
+from report import save_report
 from taiga.config import EPIC_STATUS_MAPPING, TAIGA_WEBHOOK
-from taiga.move_column import move_column
-from taiga.utils import REQUEST_TIMEOUT, Client, status_mappings
-
-# In-process lock, so it only serialises flows while the app runs as a single
-# process. Production pins `gunicorn --workers 1` for this reason: with more
-# workers each gets its own lock and two flows could move the same tickets at
-# once. See the Production section of the README.
-flow_lock = threading.Lock()
+from taiga.move_column import BULK_MOVE_SIZE, move_stories
+from taiga.utils import Client, atomic_write, safe_name, status_mappings
+
 RELEASE_LOG_FILE = "release_log.txt"
-BUG_REPORT_FILE = "report.txt"
+# One journal per unfinished run; see Journal.
+FLOW_JOURNAL_DIR = "flow_journal"
+DISCORD_FIELD_LIMIT = 1024
 
 
-def generate_bug_list(client: Client, version):
-    stories = client.list_stories(status=status_mappings["awaiting-release"])
-    with open(BUG_REPORT_FILE, "w") as f:
-        f.write(
-            f"Bugs Fixed in Version {version}\n"
-            + "\n".join([story["subject"] for story in stories])
-        )
+# Tells one run's log from the next: the file is replaced per run, so an offset a
+# reader kept from the last one means nothing in this one.
+_run_id = None
 
 
 def log_line(string):
+    """Append an entry to the release log, one JSON object per line, so the progress
+    stream can send each as it lands without reading the file again."""
+    entry = {
+        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "run": _run_id,
+        "message": string,
+    }
     with open(RELEASE_LOG_FILE, "a+") as f:
-        f.write(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {string}\n")
+        f.write(json.dumps(entry) + "\n")
 
     logging.info(string)
 
 
+def format_entry(entry: dict) -> str:
+    return f"{entry['time']} - {entry['message']}"
+
+
 def pre_flow():
     """Drop the previous run's log so the progress page only shows this one."""
+    global _run_id
+    _run_id = uuid.uuid4().hex
     pathlib.Path(RELEASE_LOG_FILE).unlink(missing_ok=True)
 
 
-def taiga_flow(is_beta: bool, version: str, candidate: str):
-    client = Client()
-    client.auth()
+def read_log(run: str | None = None, offset: int = 0) -> tuple[str | None, list]:
+    """The release log's entries from byte `offset` on, as `(offset after it,
+    entry)` pairs, and the ID of the run that wrote them.
 
-    # mark previous epic as old
-    epics = client.list_epics()
+    `offset` only counts within `run`: from a reader that last saw another run it
+    is ignored and the log is read from the start. A line still being written is
+    left for the next call."""
+    try:
+        f = open(RELEASE_LOG_FILE, "rb")
+    except FileNotFoundError:
+        return None, []
+
+    with f:
+        first = f.readline()
+        current = json.loads(first)["run"] if first.endswith(b"\n") else None
+        if current is None or current != run:
+            offset = 0
+
+        f.seek(offset)
+        entries = []
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+
+            offset += len(line)
+            entries.append((offset, json.loads(line)))
+
+    return current, entries
+
+
+@dataclass
+class Plan:
+    """Every change a flow will make, worked out from one read of the board before
+    the first write.
+
+    Plain data, so it can be printed for a dry run, serialised, and applied later
+    exactly as it was shown."""
+
+    is_beta: bool
+    version: str
+    candidate: str | None
+    epic_name: str
+    source: str
+    destination: str
+    # The current epic of this kind, to be marked old; None if there is none or the
+    # new epic already exists.
+    close_epic: dict | None = None
+    create_epic: bool = False
+    # id, version and subject of every story in the source column.
+    stories: list = field(default_factory=list)
+    # Ref and subject of each bug a release's report lists; None for a beta.
+    report: list | None = None
+
+    def estimated_requests(self) -> int:
+        """Writes this plan costs, if Taiga's bulk call takes every story."""
+        return (
+            bool(self.close_epic)
+            + self.create_epic
+            + math.ceil(len(self.stories) / BULK_MOVE_SIZE)
+        )
+
+    def describe(self) -> list[str]:
+        lines = [f"Plan for {version_name(self.is_beta, self.version, self.candidate)}"]
+        if self.close_epic:
+            lines.append(f"Mark epic '{self.close_epic['subject']}' as old")
+
+        if self.create_epic:
+            lines.append(f"Create epic '{self.epic_name}'")
+        else:
+            lines.append(f"Keep the existing epic '{self.epic_name}'")
+
+        lines.append(
+            f"Move {len(self.stories)} ticket(s) from {self.source} to {self.destination}"
+        )
+        if self.report is not None:
+            lines.append(f"Write a report of {len(self.report)} fixed bug(s)")
+
+        lines.append(f"About {self.estimated_requests()} Taiga write(s)")
+        return lines
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), indent=2)
+
+
+class Journal:
+    """What one flow run has finished, on disk, so re-running it after a failure
+    picks up where it stopped instead of starting over.
+
+    It holds the plan the run started from, the steps it completed and the tickets
+    Taiga confirmed moved. A re-run applies that same plan rather than reading the
+    board again: moved tickets have left the source column by then, and the
+    release report still has to list them. The file is removed once the run
+    succeeds, so the next run of that version plans afresh."""
+
+    def __init__(self, is_beta: bool, version: str, candidate: str):
+        key = f"{'beta' if is_beta else 'release'}-{version}"
+        if is_beta:
+            key += f"-{candidate}"
+
+        self.path = pathlib.Path(FLOW_JOURNAL_DIR) / (safe_name(key) + ".json")
+        # Move batches confirm from the scheduler's threads.
+        self._lock = threading.Lock()
+
+        try:
+            self.state = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.state = None
+
+    @property
+    def plan(self) -> Plan | None:
+        return Plan(**self.state["plan"]) if self.state else None
+
+    def is_done(self, step: str) -> bool:
+        return step in self.state["done"]
+
+    @property
+    def moved(self) -> set:
+        return set(self.state["moved"])
+
+    def start(self, plan: Plan):
+        with self._lock:
+            self.state = {"plan": asdict(plan), "done": [], "moved": []}
+            self._save()
+
+    def finish(self, step: str):
+        with self._lock:
+            self.state["done"].append(step)
+            self._save()
+
+    def record_moved(self, ids: list):
+        if not ids:
+            return
+
+        with self._lock:
+            self.state["moved"].extend(ids)
+            self._save()
+
+    def close(self):
+        self.path.unlink(missing_ok=True)
+
+    def _save(self):
+        # Swapped in whole, so a crash mid-write leaves the previous state readable.
+        self.path.parent.mkdir(exist_ok=True)
+        atomic_write(self.path, json.dumps(self.state))
 
+
+def plan_flow(client: Client, is_beta: bool, version: str, candidate: str) -> Plan:
     version_tag = "beta" if is_beta else "release"
-    name = f"{version} {version_tag.title()}{' ' + candidate if is_beta else ''} Bugs"
+    source, destination = (
+        ("fixed-internally", "in-test") if is_beta else ("awaiting-release", "done")
+    )
+    plan = Plan(
+        is_beta=is_beta,
+        version=version,
+        candidate=candidate,
+        epic_name=f"{version} {version_tag.title()}{' ' + candidate if is_beta else ''} Bugs",
+        source=source,
+        destination=destination,
+    )
 
+    epics = client.list_epics()
     # no need to recreate an existing epic
-    log_line("Closing previous epic and creating new one")
-    if not any(name in epic["subject"] for epic in epics):
-        try:
-            epic = next(
+    if not any(plan.epic_name in epic["subject"] for epic in epics):
+        plan.create_epic = True
+        current = next(
+            (
                 epic
                 for epic in epics
                 if epic["status_extra_info"]["name"] == "Current"
                 and version_tag in epic["subject"].lower()
-            )
-
-            client.update_epic(
-                epic["id"],
-                epic["version"],
-                status=EPIC_STATUS_MAPPING["old"],
-                order="3",
-            )
-        except StopIteration:
+            ),
+            None,
+        )
+        if current is None:
             logging.error("Could not close previous epic for %s", version_tag)
+        else:
+            plan.close_epic = {
+                key: current[key] for key in ("id", "version", "subject")
+            }
 
-        # make new epic
-        client.create_epic(name, status=EPIC_STATUS_MAPPING["current"])
-    else:
-        logging.info(
-            "Skipping epic creation because duplicate already exists for %s", name
+    stories = [
+        story
+        for page in client.iter_story_pages(
+            status=status_mappings[source], prefetch=True
         )
+        for story in page
+    ]
+    plan.stories = [
+        {key: story[key] for key in ("id", "version", "subject")} for story in stories
+    ]
+    if not is_beta:
+        plan.report = [
+            {"ref": story.get("ref"), "subject": story["subject"]} for story in stories
+        ]
+
+    return plan
+
+
+def apply_plan(client: Client, plan: Plan, journal: Journal):
+    """Make the plan's changes, skipping whatever `journal` says is already done.
+
+    The epic rotation and the column move touch nothing in common, so they go out
+    together."""
+    steps = {}
+    if plan.close_epic:
+        steps["close_epic"] = lambda: client.update_epic(
+            plan.close_epic["id"],
+            plan.close_epic["version"],
+            status=EPIC_STATUS_MAPPING["old"],
+            order="3",
+        )
+
+    if plan.create_epic:
+        steps["create_epic"] = lambda: client.create_epic(
+            plan.epic_name, status=EPIC_STATUS_MAPPING["current"]
+        )
+
+    moved = journal.moved
+    steps["move"] = lambda: move_stories(
+        client,
+        [story for story in plan.stories if story["id"] not in moved],
+        status_mappings[plan.destination],
+        on_moved=journal.record_moved,
+    )
+
+    if plan.report is not None:
+        save_report(plan.version, plan.report)
+
+    def run(step: str):
+        steps[step]()
+        journal.finish(step)
+
+    client.scheduler.map(run, [step for step in steps if not journal.is_done(step)])
 
-    if is_beta:
-        log_line("Moving tickets from fixed-internally to in-test")
-        move_column(client, "fixed-internally", "in-test")
+
+def taiga_flow(client: Client, is_beta: bool, version: str, candidate: str):
+    journal = Journal(is_beta, version, candidate)
+    plan = journal.plan
+    if plan is None:
+        log_line("Reading the board")
+        plan = plan_flow(client, is_beta, version, candidate)
+        journal.start(plan)
     else:
-        # generate bug list
-        log_line("Moving tickets from awaiting-release to done")
-        generate_bug_list(client, version)
-        move_column(client, "awaiting-release", "done")
+        log_line(
+            f"Resuming an earlier run: {', '.join(journal.state['done']) or 'no step'}"
+            f" done, {len(journal.moved)} of {len(plan.stories)} ticket(s) moved"
+        )
+
+    for line in plan.describe():
+        log_line(line)
+
+    apply_plan(client, plan, journal)
+    journal.close()
 
 
 def version_name(is_beta: bool, version: str, candidate: str) -> str:
@@ -93,24 +310,38 @@ def version_name(is_beta: bool, version: str, candidate: str) -> str:
     return f"{version} {version_tag}{' ' + candidate if is_beta else ''}"
 
 
-def post_flow(is_beta: bool, version: str, candidate: str, user: User):
+def log_metrics(client: Client):
+    for line in client.session.metrics.summary():
+        log_line(f"Taiga: {line}")
+
+
+def post_flow(
+    is_beta: bool, version: str, candidate: str, ordered_by: str, client: Client
+):
     log_line("Sending webhook")
     name = version_name(is_beta, version, candidate)
+    summary = "\n".join(client.session.metrics.summary())
     data = {
         "content": None,
         "embeds": [
             {
                 "title": "Board Updated!",
-                "description": f"Ordered by **{user.username}**\nThe Taiga board is ready for **{name}**!",
+                "description": f"Ordered by **{ordered_by}**\nThe Taiga board is ready for **{name}**!",
                 "color": 5814783,
-                "fields": [],
+                "fields": [
+                    {
+                        "name": "Taiga calls",
+                        # Discord caps a field value at 1024 characters.
+                        "value": f"```\n{summary[:DISCORD_FIELD_LIMIT - 8]}\n```",
+                    }
+                ],
             }
         ],
         "username": "Edain Manager",
         "attachments": [],
     }
 
-    requests.post(TAIGA_WEBHOOK, json=data, timeout=REQUEST_TIMEOUT)
+    default_relay.enqueue(TAIGA_WEBHOOK, data)
 
 
 def error_flow(is_beta: bool, version: str, candidate: str, error: Exception):
@@ -133,32 +364,31 @@ def error_flow(is_beta: bool, version: str, candidate: str, error: Exception):
     }
 
     logging.exception("Failed to update the board for %s", name)
-    requests.post(TAIGA_WEBHOOK, json=data, timeout=REQUEST_TIMEOUT)
+    default_relay.enqueue(TAIGA_WEBHOOK, data)
 
 
-def run_flows(is_beta: bool, version: str, candidate: str, user: User):
-    # Non-blocking: the caller already rejected the request if a flow was running,
-    # so a failure here means we lost a race and must not silently queue a flow.
-    if not flow_lock.acquire(blocking=False):
-        logging.warning(
-            "Refusing concurrent flow for %s, one is already running", version
-        )
-        return
-
+def run_flows(is_beta: bool, version: str, candidate: str, ordered_by: str):
+    """Run one flow; called by :class:`jobs.FlowQueue`, which keeps it the only one
+    running and records how it ended."""
     try:
-        _run_flows(is_beta, version, candidate, user)
+        _run_flows(is_beta, version, candidate, ordered_by)
     except Exception as e:
         error_flow(is_beta, version, candidate, e)
-    finally:
-        flow_lock.release()
+        raise
 
 
-def _run_flows(is_beta: bool, version: str, candidate: str, user: User):
-    log_line("Starting taiga process...")
+def _run_flows(is_beta: bool, version: str, candidate: str, ordered_by: str):
     pre_flow()
+    log_line("Starting taiga process...")
 
     log_line("Running taiga flow")
-    taiga_flow(is_beta, version, candidate)
+    client = Client()
+    try:
+        client.auth()
+        taiga_flow(client, is_beta, version, candidate)
+    finally:
+        # On a failure too: where the time went is half of what is asked next.
+        log_metrics(client)
 
-    post_flow(is_beta, version, candidate, user)
+    post_flow(is_beta, version, candidate, ordered_by, client)
     log_line("Done taiga process...")
@@ -0,0 +1,233 @@
+"""The queue release and beta flows wait in, shared by every process that can start one.
+
+A flow used to be guarded by a `threading.Lock`, which only held inside one process,
+so the app had to run as a single gunicorn worker. Jobs now live in SQLite instead,
+and whichever process claims the next one runs it: the claim is a single write
+transaction that fails while another job is running, so only one flow touches the
+board at a time however many workers (or `cli.py` runs) are about.
+
+A runner that dies mid-flow cannot release its claim, so a running job carries a
+heartbeat, and one that has not beaten for `FLOW_LEASE` seconds is marked failed when
+the next claim is tried. Its journal (see `flows.Journal`) lets it be resubmitted
+and resume.
+"""
+
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterator
+
+FLOW_QUEUE_DB = "flows.sqlite3"
+# A running job that has not beaten for this long is taken to be dead.
+FLOW_LEASE = 300
+FLOW_HEARTBEAT = 30
+# Finished jobs kept for the history.
+FLOW_HISTORY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    is_beta INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    candidate TEXT,
+    ordered_by TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat REAL,
+    runner TEXT,
+    error TEXT
+);
+-- The same flow can be waiting or running only once.
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending
+    ON jobs (is_beta, version, IFNULL(candidate, ''))
+    WHERE state IN ('queued', 'running');
+-- And only one of any flow can be running.
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_running ON jobs (state) WHERE state = 'running';
+"""
+
+COLUMNS = (
+    "id",
+    "is_beta",
+    "version",
+    "candidate",
+    "ordered_by",
+    "state",
+    "submitted_at",
+    "started_at",
+    "finished_at",
+    "error",
+)
+
+
+class DuplicateJob(Exception):
+    """The same flow is already queued or running."""
+
+
+class FlowQueue:
+    def __init__(self, path: str = FLOW_QUEUE_DB):
+        self.path = path
+        self.runner = f"{socket.gethostname()}:{os.getpid()}"
+
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # isolation_level None, so each `BEGIN IMMEDIATE` below is the whole
+        # transaction: the write lock is taken before anything is read.
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode = WAL")
+            yield db
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def submit(
+        self, is_beta: bool, version: str, candidate: str | None, ordered_by: str
+    ) -> int:
+        """Queue a flow and return its job ID; raises :class:`DuplicateJob` if the
+        same one is already waiting or running."""
+        try:
+            with self._transaction() as db:
+                return db.execute(
+                    "INSERT INTO jobs (is_beta, version, candidate, ordered_by,"
+                    " submitted_at) VALUES (?, ?, ?, ?, ?)",
+                    (is_beta, version, candidate, ordered_by, time.time()),
+                ).lastrowid
+        except sqlite3.IntegrityError:
+            raise DuplicateJob(f"{version} is already queued or running") from None
+
+    def _rows(self, query: str, params=()) -> list[dict]:
+        with self._connect() as db:
+            rows = db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs {query}", params
+            ).fetchall()
+
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def pending(self) -> list[dict]:
+        """The running job, if any, then the queued ones in order.
+
+        A job whose runner went silent is failed first, as `claim` would: otherwise
+        it would count as running until something else tried to claim, and the
+        release pages submit nothing while a job is pending."""
+        with self._connect() as db:
+            stale = db.execute(
+                "SELECT 1 FROM jobs WHERE state = 'running' AND heartbeat < ?",
+                (time.time() - FLOW_LEASE,),
+            ).fetchone()
+        if stale:
+            with self._transaction() as db:
+                self._expire(db)
+
+        return self._rows(
+            "WHERE state IN ('queued', 'running')"
+            " ORDER BY state = 'queued', submitted_at"
+        )
+
+    def history(self, limit: int = 20) -> list[dict]:
+        return self._rows("ORDER BY id DESC LIMIT ?", (limit,))
+
+    def _expire(self, db: sqlite3.Connection):
+        expired = db.execute(
+            "UPDATE jobs SET state = 'failed', finished_at = ?,"
+            " error = 'The runner stopped answering'"
+            " WHERE state = 'running' AND heartbeat < ?",
+            (time.time(), time.time() - FLOW_LEASE),
+        ).rowcount
+        if expired:
+            logging.warning("Marked a flow failed after its runner went silent")
+
+    def claim(self) -> dict | None:
+        """Take the next queued job, unless one is running already."""
+        with self._transaction() as db:
+            self._expire(db)
+            if db.execute("SELECT 1 FROM jobs WHERE state = 'running'").fetchone():
+                return None
+
+            row = db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE state = 'queued'"
+                " ORDER BY submitted_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+
+            job = dict(zip(COLUMNS, row))
+            now = time.time()
+            db.execute(
+                "UPDATE jobs SET state = 'running', started_at = ?, heartbeat = ?,"
+                " runner = ? WHERE id = ?",
+                (now, now, self.runner, job["id"]),
+            )
+
+        return job
+
+    def _beat(self, job_id: int, stop: threading.Event):
+        while not stop.wait(FLOW_HEARTBEAT):
+            with self._transaction() as db:
+                db.execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE id = ? AND runner = ?",
+                    (time.time(), job_id, self.runner),
+                )
+
+    def finish(self, job_id: int, error: str | None = None):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, finished_at = ?, error = ? WHERE id = ?",
+                ("failed" if error else "done", time.time(), error, job_id),
+            )
+            db.execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') AND id NOT IN"
+                " (SELECT id FROM jobs ORDER BY id DESC LIMIT ?)",
+                (FLOW_HISTORY,),
+            )
+
+    def drain(self, run: Callable):
+        """Run queued jobs through `run` until there are none this process can
+        claim."""
+        while job := self.claim():
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=self._beat, args=(job["id"], stop), daemon=True
+            )
+            heartbeat.start()
+            try:
+                run(
+                    bool(job["is_beta"]),
+                    job["version"],
+                    job["candidate"],
+                    job["ordered_by"],
+                )
+            except Exception as e:
+                self.finish(job["id"], f"{type(e).__name__}: {e}")
+            else:
+                self.finish(job["id"])
+            finally:
+                stop.set()
+                heartbeat.join()
+
+    def start(self, run: Callable):
+        """Drain the queue on a background thread.
+
+        Off the request thread: a flow is a chain of Taiga calls, and on a busy board
+        (or a slow Taiga) it can outlast gunicorn's 30s worker timeout. Starting one
+        while another runner is busy costs a single failed claim, so this is called
+        after every submission rather than tracking who is draining."""
+        threading.Thread(target=self.drain, args=(run,)).start()
@@ -0,0 +1,120 @@
+"""Who is signed in to the team pages, remembered for a few minutes.
+
+Every team page checks the visitor's roles in the Discord guild, and asking Discord
+on each view made bursts of navigation run into its rate limit. The answer is kept
+here per OAuth token for `MEMBER_TTL` seconds. A view in the last `MEMBER_REFRESH`
+seconds of that asks again on a background thread, so somebody moving around the
+pages never waits on Discord after their first view.
+
+Per process and in memory: a role taken away still counts until the entry expires,
+which is as long as the TTL.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+
+import requests
+
+from taiga.utils import REQUEST_TIMEOUT
+
+DISCORD_API = "https://discord.com/api"
+MEMBER_TTL = 300
+MEMBER_REFRESH = 60
+MEMBER_CACHE_SIZE = 256
+
+
+class MemberCache:
+    def __init__(
+        self,
+        guild_id,
+        *,
+        ttl: float = MEMBER_TTL,
+        refresh: float = MEMBER_REFRESH,
+        size: int = MEMBER_CACHE_SIZE,
+    ):
+        self.guild_id = guild_id
+        self.ttl = ttl
+        self.refresh = refresh
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # Oldest first; key -> (fetched at, member).
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: dict) -> str:
+        # The token itself is not kept around, only what identifies it.
+        return hashlib.sha256(token["access_token"].encode()).hexdigest()
+
+    def _store(self, key: str, member: dict):
+        # Only what the role check reads.
+        member = {"user": member.get("user"), "roles": member.get("roles")}
+        with self._lock:
+            self._entries[key] = (time.monotonic(), member)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return member
+
+    def get(self, token: dict, fetch: Callable[[], dict]) -> dict:
+        """The guild member for `token`, calling `fetch` only if it is not known or
+        has expired. `fetch`'s exceptions (a rate limit, say) are left to the
+        caller."""
+        key = self._key(token)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                refresh = (
+                    now - entry[0] > self.ttl - self.refresh
+                    and key not in self._refreshing
+                )
+                if refresh:
+                    self._refreshing.add(key)
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            return self._store(key, fetch())
+
+        if refresh:
+            threading.Thread(
+                target=self._refresh,
+                args=(key, token["access_token"]),
+                daemon=True,
+            ).start()
+
+        return entry[1]
+
+    def _refresh(self, key: str, access_token: str):
+        # Outside any request, so with the bare token rather than flask_discord's
+        # session. On a failure the entry is left to expire, and the next view
+        # after that asks in the foreground.
+        try:
+            response = requests.get(
+                f"{DISCORD_API}/users/@me/guilds/{self.guild_id}/member",
+                headers={"Authorization": f"Bearer {access_token}"},
+                timeout=REQUEST_TIMEOUT,
+            )
+            if response.ok:
+                self._store(key, response.json())
+            else:
+                logging.info(
+                    "Could not refresh a guild member: %s", response.status_code
+                )
+        except requests.RequestException:
+            logging.exception("Could not refresh a guild member")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -20,8 +20,10 @@ import logging
 import re
 import secrets
 import shutil
+import threading
 import time
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from tempfile import gettempdir
@@ -75,6 +77,19 @@ SAGEPATCH_HEADER = (
     "Regenerate it whenever the binary is repatched: `sage-patch sagepatch <game.dat>`.",
 )
 
+#: Patch runs at once, across every request. Patching is CPU work, and a server taking requests
+#: concurrently would otherwise run as many as people submit and starve the downloads and the
+#: webhook of the Pi's cores; past this many, a run waits for a free slot.
+PATCH_WORKERS = 2
+
+_patch_pool = ThreadPoolExecutor(max_workers=PATCH_WORKERS, thread_name_prefix="patch")
+
+#: Runs waiting for a slot and running, and the size of each workspace this process wrote and has
+#: not swept yet - kept up to date as they change, so a status check never walks `OUTPUT_ROOT`.
+_runs = {"queued": 0, "running": 0}
+_workspaces: dict[str, int] = {}
+_gauge_lock = threading.Lock()
+
 _TOKEN = re.compile(r"\A[A-Za-z0-9_-]{16,64}\Z")
 
 
@@ -362,6 +377,22 @@ def sweep() -> None:
 
         if expired:
             shutil.rmtree(workspace, ignore_errors=True)
+            with _gauge_lock:
+                _workspaces.pop(workspace.name, None)
+
+
+def gauges() -> dict[str, int]:
+    """This process's patch runs and the workspaces it is keeping, for the status endpoints.
+
+    Workspaces written before a restart, or by another worker, are not counted: they are known
+    only to the sweep, and counting them would mean the directory walk this avoids.
+    """
+    with _gauge_lock:
+        return {
+            **_runs,
+            "workspaces": len(_workspaces),
+            "workspace_bytes": sum(_workspaces.values()),
+        }
 
 
 def _upload_for(selection: Selection, files: Mapping[str, FileStorage]) -> FileStorage:
@@ -495,18 +526,41 @@ def apply_selected(
 
     token = secrets.token_urlsafe(16)
     workspace = OUTPUT_ROOT / token
+    with _gauge_lock:
+        _runs["queued"] += 1
     try:
-        patched = tuple(
-            _patch_one(selection, upload, workspace)
-            for selection, upload in zip(chosen, uploads)
-        )
+        patched = _patch_pool.submit(_run, chosen, uploads, workspace).result()
     except PatchError:
         shutil.rmtree(workspace, ignore_errors=True)
         raise
 
+    size = sum(f.patched_size for f in patched) + sum(
+        (workspace / "sagepatch" / f.slug / SAGEPATCH_NAME).stat().st_size
+        for f in patched
+        if f.sagepatch
+    )
+    with _gauge_lock:
+        _workspaces[token] = size
+
     return PatchResult(token=token, files=patched)
 
 
+def _run(
+    chosen: list[Selection], uploads: list[FileStorage], workspace: Path
+) -> tuple[PatchedFile, ...]:
+    with _gauge_lock:
+        _runs["queued"] -= 1
+        _runs["running"] += 1
+    try:
+        return tuple(
+            _patch_one(selection, upload, workspace)
+            for selection, upload in zip(chosen, uploads)
+        )
+    finally:
+        with _gauge_lock:
+            _runs["running"] -= 1
+
+
 def download_name(output: Path, slug: str, sagepatch: bool) -> str:
     """What to call `output` on the way out, which for a `.sagepatch` is not what it is called
     where it is going.
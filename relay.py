@@ -0,0 +1,460 @@
+"""Messages for Discord, kept on disk until Discord has taken them.
+
+The Taiga webhook used to post to Discord inside the request, so a slow or
+rate-limited Discord held the worker and made Taiga time out and deliver the event
+again. Messages now go into an outbox in SQLite and the request returns; a worker
+thread posts them in order over one pooled session, waits out Discord's rate limits
+from its headers, and retries failures with backoff. A message Discord refuses
+outright (a 4xx other than 429) would be refused again, so it is set aside as dead
+rather than retried.
+
+Ticket events are not posted one by one: during triage one person can open ten
+tickets and comment on twenty in a few minutes, and a message each runs straight
+into Discord's webhook limit. They are staged instead, and `RELAY_COALESCE_WINDOW`
+after the first of a burst arrives the burst is turned into messages: the events for
+one ticket by one author are merged (several comments become one embed), and the
+embeds are packed as many to a message as Discord takes.
+
+Any process may deliver: a message is leased for `RELAY_LEASE` seconds by whoever
+takes it, so two workers do not post it twice, and one left behind by a process
+that died is picked up once the lease runs out.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+
+import requests
+
+from taiga.utils import REQUEST_TIMEOUT, backoff, retry_after
+
+RELAY_DB = "relay.sqlite3"
+# Attempts before a message is given up on, not counting rate limits.
+RELAY_MAX_ATTEMPTS = 8
+# How long a message is held by the worker that took it.
+RELAY_LEASE = 60
+# How long an idle worker sleeps when nothing wakes it.
+RELAY_IDLE = 30
+# Dead messages kept for inspection.
+RELAY_DEAD_KEPT = 100
+# How long the first event of a burst waits for the rest.
+RELAY_COALESCE_WINDOW = 20
+
+# Webhook deliveries remembered, to spot Taiga sending one again.
+DEDUP_SIZE = 10000
+DEDUP_TTL = 7 * 24 * 3600
+
+# Discord rejects the whole webhook payload past these.
+DISCORD_DESCRIPTION_LIMIT = 4096
+DISCORD_EMBEDS_PER_MESSAGE = 10
+DISCORD_MESSAGE_EMBED_CHARS = 6000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    next_attempt REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, next_attempt, id);
+
+-- Embeds waiting for the rest of their burst; `envelope` is the message around them.
+CREATE TABLE IF NOT EXISTS staged (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    envelope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    embed TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+
+-- Webhook deliveries already taken, newest last.
+CREATE TABLE IF NOT EXISTS seen (
+    key TEXT PRIMARY KEY,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def event_key(event: dict) -> str:
+    """What identifies a Taiga webhook delivery: its type, object and change,
+    readable for debugging, and a hash of the whole payload, since a change carries
+    no ID of its own and two edits can share a timestamp."""
+    change = event.get("change") or {}
+    digest = hashlib.sha256(json.dumps(event, sort_keys=True).encode()).hexdigest()[:16]
+    return ":".join(
+        str(part)
+        for part in (
+            event.get("type"),
+            (event.get("data") or {}).get("id"),
+            change.get("id") or event.get("date"),
+            digest,
+        )
+    )
+
+
+def embed_size(embed: dict) -> int:
+    """The characters Discord counts against a message's total."""
+    return (
+        len(embed.get("title") or "")
+        + len(embed.get("description") or "")
+        + sum(len(f["name"]) + len(f["value"]) for f in embed.get("fields", []))
+    )
+
+
+def coalesce(staged: list) -> list:
+    """Merge `(key, embed)` pairs, in arrival order: embeds with the same key and
+    title become one, their descriptions joined."""
+    merged = {}
+    for key, embed in staged:
+        group = merged.setdefault((key, embed.get("title")), [])
+        group.append(embed)
+
+    embeds = []
+    for (_, title), group in merged.items():
+        embed = dict(group[0])
+        if len(group) > 1:
+            embed["title"] = f"{title} (x{len(group)})"
+            description = "\n\n".join(e.get("description") or "" for e in group)
+            if len(description) > DISCORD_DESCRIPTION_LIMIT:
+                description = description[: DISCORD_DESCRIPTION_LIMIT - 1] + "…"
+            embed["description"] = description
+
+        embeds.append(embed)
+
+    return embeds
+
+
+def pack(embeds: list) -> list:
+    """Split `embeds` into as few messages' worth as Discord's limits allow."""
+    messages, current, size = [], [], 0
+    for embed in embeds:
+        if current and (
+            len(current) == DISCORD_EMBEDS_PER_MESSAGE
+            or size + embed_size(embed) > DISCORD_MESSAGE_EMBED_CHARS
+        ):
+            messages.append(current)
+            current, size = [], 0
+
+        current.append(embed)
+        size += embed_size(embed)
+
+    if current:
+        messages.append(current)
+
+    return messages
+
+
+def rate_limit_reset(response: requests.Response) -> float | None:
+    """Seconds until Discord takes another message, if this response says."""
+    if response.headers.get("X-RateLimit-Remaining") != "0":
+        return None
+
+    try:
+        return float(response.headers["X-RateLimit-Reset-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+class Relay:
+    def __init__(self, path: str = RELAY_DB):
+        self.path = path
+        self.session = requests.Session()
+        self.sent = 0
+        self.failed = 0
+        # Deliveries seen before, and first seen, by this process.
+        self.duplicates = 0
+        self.first_seen = 0
+        # backlog() as of the worker's last pass, which follows every enqueue, for
+        # status checks that should not query the outbox themselves.
+        self.pending = 0
+
+        # Discord's bucket, shared by every message this process sends.
+        self._resume_at = 0.0
+        self._ready = False
+        self._wake = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode = WAL")
+            # Created on first use rather than on import, so importing flows does not
+            # leave a database wherever it was imported from.
+            if not self._ready:
+                db.executescript(SCHEMA)
+                self._ready = True
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, url: str, payload: dict) -> int:
+        """Store `payload` for `url` and wake the worker; returns at once."""
+        with self._connect() as db:
+            message_id = db.execute(
+                "INSERT INTO outbox (url, payload, created_at, next_attempt)"
+                " VALUES (?, ?, ?, ?)",
+                (url, json.dumps(payload), time.time(), time.time()),
+            ).lastrowid
+
+        self.start()
+        self._wake.set()
+        return message_id
+
+    def first_delivery(self, event: dict) -> bool:
+        """Record a webhook delivery; False if the same one was already taken.
+
+        Kept in the database, so a retry that lands after a restart, or on another
+        worker, is still caught; the oldest entries are dropped past `DEDUP_SIZE`
+        or `DEDUP_TTL`."""
+        with self._connect() as db:
+            fresh = db.execute(
+                "INSERT OR IGNORE INTO seen (key, created_at) VALUES (?, ?)",
+                (event_key(event), time.time()),
+            ).rowcount
+            if fresh:
+                db.execute(
+                    "DELETE FROM seen WHERE created_at < ? OR rowid <="
+                    " (SELECT MAX(rowid) FROM seen) - ?",
+                    (time.time() - DEDUP_TTL, DEDUP_SIZE),
+                )
+
+        if fresh:
+            self.first_seen += 1
+        else:
+            self.duplicates += 1
+            logging.info(
+                "Dropped a repeated webhook delivery (%d of %d seen so far)",
+                self.duplicates,
+                self.duplicates + self.first_seen,
+            )
+
+        return bool(fresh)
+
+    def forget_delivery(self, event: dict):
+        """Undo :meth:`first_delivery` for an event that failed, so Taiga's retry of
+        it is processed rather than dropped."""
+        with self._connect() as db:
+            db.execute("DELETE FROM seen WHERE key = ?", (event_key(event),))
+
+    def stage(self, url: str, envelope: dict, key: str, embed: dict):
+        """Hold `embed` for `url` to go out with the rest of its burst; `key` says
+        which others it may be merged with, and `envelope` is the message it is
+        sent in, with `embeds` left out."""
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO staged (url, envelope, key, embed, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (url, json.dumps(envelope), key, json.dumps(embed), time.time()),
+            )
+
+        self.start()
+        self._wake.set()
+
+    def _release_staged(self, db: sqlite3.Connection):
+        """Turn every burst whose window has closed into outbox messages. Runs in
+        the caller's transaction, so a burst is released once."""
+        now = time.time()
+        bursts = db.execute(
+            "SELECT url, envelope FROM staged GROUP BY url, envelope"
+            " HAVING MIN(created_at) <= ?",
+            (now - RELAY_COALESCE_WINDOW,),
+        ).fetchall()
+
+        for url, envelope in bursts:
+            rows = db.execute(
+                "SELECT id, key, embed FROM staged WHERE url = ? AND envelope = ?"
+                " ORDER BY id",
+                (url, envelope),
+            ).fetchall()
+            db.execute(
+                f"DELETE FROM staged WHERE id IN ({', '.join('?' * len(rows))})",
+                [row[0] for row in rows],
+            )
+
+            embeds = coalesce([(key, json.loads(embed)) for _, key, embed in rows])
+            for chunk in pack(embeds):
+                db.execute(
+                    "INSERT INTO outbox (url, payload, created_at, next_attempt)"
+                    " VALUES (?, ?, ?, ?)",
+                    (
+                        url,
+                        json.dumps({**json.loads(envelope), "embeds": chunk}),
+                        now,
+                        now,
+                    ),
+                )
+
+            logging.info(
+                "Coalesced %d event(s) into %d embed(s)", len(rows), len(embeds)
+            )
+
+    def backlog(self) -> int:
+        """Messages and staged events waiting to be delivered."""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT (SELECT COUNT(*) FROM outbox WHERE dead = 0)"
+                " + (SELECT COUNT(*) FROM staged)"
+            ).fetchone()
+
+        return row[0]
+
+    def _take(self) -> tuple | None:
+        """Lease the oldest message that is due, or return None."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._release_staged(db)
+                row = db.execute(
+                    "SELECT id, url, payload, attempts FROM outbox"
+                    " WHERE dead = 0 AND next_attempt <= ? ORDER BY id LIMIT 1",
+                    (time.time(),),
+                ).fetchone()
+                if row:
+                    db.execute(
+                        "UPDATE outbox SET next_attempt = ? WHERE id = ?",
+                        (time.time() + RELAY_LEASE, row[0]),
+                    )
+            except BaseException:
+                # Half a released burst would lose its events.
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+        return row
+
+    def _next_due(self) -> float | None:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT MIN(next_attempt) FROM outbox WHERE dead = 0"
+                " UNION ALL SELECT MIN(created_at) + ? FROM staged",
+                (RELAY_COALESCE_WINDOW,),
+            ).fetchall()
+
+        return min((due for (due,) in row if due is not None), default=None)
+
+    def deliver_one(self) -> bool:
+        """Post the oldest due message; False if none was due."""
+        wait = self._resume_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        message = self._take()
+        if message is None:
+            return False
+
+        message_id, url, payload, attempts = message
+        try:
+            response = self.session.post(
+                url,
+                data=payload,
+                timeout=REQUEST_TIMEOUT,
+                headers={"Content-Type": "application/json"},
+            )
+        except requests.RequestException as e:
+            self._retry(message_id, attempts, repr(e))
+            return True
+
+        reset = rate_limit_reset(response)
+        if response.status_code == 429:
+            delay = retry_after(response) or reset or 1
+            self._resume_at = time.monotonic() + delay
+            # Not the message's fault, so not an attempt.
+            self._reschedule(message_id, attempts, time.time() + delay, "429")
+        elif response.ok:
+            with self._connect() as db:
+                db.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+            self.sent += 1
+        elif response.status_code >= 500:
+            self._retry(message_id, attempts, f"{response.status_code} {response.text}")
+        else:
+            self._bury(message_id, f"{response.status_code} {response.text}")
+
+        if reset:
+            self._resume_at = max(self._resume_at, time.monotonic() + reset)
+
+        return True
+
+    def _reschedule(self, message_id: int, attempts: int, at: float, error: str):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ?"
+                " WHERE id = ?",
+                (attempts, at, error, message_id),
+            )
+
+    def _retry(self, message_id: int, attempts: int, error: str):
+        attempts += 1
+        if attempts >= RELAY_MAX_ATTEMPTS:
+            self._bury(message_id, error)
+            return
+
+        logging.warning("Discord delivery failed, retrying: %s", error)
+        self._reschedule(message_id, attempts, time.time() + backoff(attempts), error)
+
+    def _bury(self, message_id: int, error: str):
+        logging.error("Gave up delivering message %s to Discord: %s", message_id, error)
+        self.failed += 1
+        with self._connect() as db:
+            db.execute(
+                "UPDATE outbox SET dead = 1, last_error = ? WHERE id = ?",
+                (error, message_id),
+            )
+            db.execute(
+                "DELETE FROM outbox WHERE dead = 1 AND id NOT IN"
+                " (SELECT id FROM outbox WHERE dead = 1 ORDER BY id DESC LIMIT ?)",
+                (RELAY_DEAD_KEPT,),
+            )
+
+    def flush(self, timeout: float = REQUEST_TIMEOUT):
+        """Deliver what is due now, for a process about to exit (`cli.py`) that
+        cannot leave it to a worker thread. Anything still undelivered after
+        `timeout` stays in the outbox for the app to send."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.deliver_one():
+                next_due = self._next_due()
+                if (
+                    next_due is None
+                    or next_due - time.time() > deadline - time.monotonic()
+                ):
+                    return
+                time.sleep(max(0.0, next_due - time.time()))
+
+    def _run(self):
+        while True:
+            try:
+                while self.deliver_one():
+                    pass
+                next_due = self._next_due()
+                self.pending = self.backlog()
+            except Exception:
+                # A worker that dies stops every message behind it, so it logs and
+                # carries on.
+                logging.exception("Discord relay worker failed")
+                next_due = None
+
+            wait = RELAY_IDLE if next_due is None else next_due - time.time()
+            self._wake.wait(min(max(wait, 0.0), RELAY_IDLE))
+            self._wake.clear()
+
+    def start(self):
+        """Start this process's delivery worker, if it has none yet."""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+
+default_relay = Relay()
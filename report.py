@@ -0,0 +1,237 @@
+"""The fixed-bug report a release flow leaves behind, and the forms `/bugs` serves it in.
+
+A release writes one JSON file per version from the stories its plan already read, so
+the report costs no Taiga call of its own. Reading one back is cached against the
+file's mtime, and each rendered form is kept beside it, so a page view after the first
+is a `stat` and a dictionary lookup rather than a read and a re-render.
+"""
+
+import json
+import os
+import pathlib
+import re
+import threading
+import time
+
+from taiga.utils import atomic_write, safe_name
+
+REPORT_DIR = "reports"
+# Where a release wrote its report before there was one per version.
+LEGACY_REPORT_FILE = "report.txt"
+LEGACY_HEADER = "Bugs Fixed in Version "
+FORMATS = ("text", "markdown", "json")
+
+# Keyed by path; each entry holds the mtime it was read at, the report and the forms
+# rendered from it so far. The directory listing is cached the same way, against the
+# directory's own mtime, which moves whenever a report is added or replaced.
+_cache = {}
+_index = {"mtime": None, "versions": []}
+_lock = threading.Lock()
+
+
+def _path(version: str) -> pathlib.Path:
+    return pathlib.Path(REPORT_DIR) / (safe_name(version) + ".json")
+
+
+def _store(version: str, bugs: list, generated_at: float):
+    path = _path(version)
+    path.parent.mkdir(exist_ok=True)
+
+    # Swapped in whole, so a page view never reads half a report.
+    atomic_write(
+        path,
+        json.dumps({"version": version, "generated_at": generated_at, "bugs": bugs}),
+    )
+
+
+def save_report(version: str, bugs: list):
+    """Store the report for `version`; `bugs` holds each fixed story's ref and
+    subject."""
+    if not os.path.isdir(REPORT_DIR):
+        _import_legacy()
+
+    _store(version, bugs, time.time())
+
+
+def _import_legacy() -> bool:
+    """Store the last `report.txt` as its version's report, so the one written before
+    an upgrade is still served. Its subjects come without refs."""
+    try:
+        text = pathlib.Path(LEGACY_REPORT_FILE).read_text()
+    except FileNotFoundError:
+        return False
+
+    header, _, body = text.partition("\n")
+    if not header.startswith(LEGACY_HEADER):
+        return False
+
+    bugs = [{"ref": None, "subject": line} for line in body.split("\n") if line]
+    _store(
+        header.removeprefix(LEGACY_HEADER),
+        bugs,
+        os.stat(LEGACY_REPORT_FILE).st_mtime,
+    )
+    return True
+
+
+def versions() -> list:
+    """Every version with a report, oldest first by when it was written."""
+    try:
+        mtime = os.stat(REPORT_DIR).st_mtime_ns
+    except FileNotFoundError:
+        # Only until the first report is stored, which creates the directory.
+        if not _import_legacy():
+            return []
+        mtime = os.stat(REPORT_DIR).st_mtime_ns
+
+    with _lock:
+        if _index["mtime"] != mtime:
+            entries = sorted(
+                pathlib.Path(REPORT_DIR).glob("*.json"),
+                key=lambda entry: entry.stat().st_mtime_ns,
+            )
+            _index.update(
+                mtime=mtime,
+                versions=[
+                    json.loads(entry.read_text())["version"] for entry in entries
+                ],
+            )
+
+        return list(_index["versions"])
+
+
+def _load(version: str) -> dict | None:
+    path = _path(version)
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _lock:
+        entry = _cache.get(path)
+        if entry is None or entry["mtime"] != mtime:
+            entry = {
+                "mtime": mtime,
+                "report": json.loads(path.read_text()),
+                "rendered": {},
+            }
+            _cache[path] = entry
+
+        return entry
+
+
+def load_report(version: str = None) -> dict | None:
+    """The report for `version`, or the latest one; None if there is none."""
+    if version is None:
+        known = versions()
+        if not known:
+            return None
+        version = known[-1]
+
+    entry = _load(version)
+    return entry and entry["report"]
+
+
+def previous_version(version: str) -> str | None:
+    """The version whose report was written before `version`'s."""
+    known = versions()
+    if version not in known:
+        return None
+
+    index = known.index(version)
+    return known[index - 1] if index else None
+
+
+def _escape_markdown(text: str) -> str:
+    # Only what Discord would format inline: every line is a list item or a heading
+    # already, so a `#` or `>` inside one is left alone.
+    return re.sub(r"([\\`*_~|\[\]])", r"\\\1", text)
+
+
+def _line(bug: dict) -> str:
+    return f"#{bug['ref']} {bug['subject']}" if bug.get("ref") else bug["subject"]
+
+
+def _render(report: dict, format: str) -> str:
+    if format == "json":
+        return json.dumps(report, indent=2)
+
+    if format == "markdown":
+        return (
+            f"## Bugs fixed in version {_escape_markdown(report['version'])}\n\n"
+            + "".join(f"- {_escape_markdown(_line(bug))}\n" for bug in report["bugs"])
+        )
+
+    # The layout report.txt always had, which the team pastes as is.
+    return f"Bugs Fixed in Version {report['version']}\n" + "\n".join(
+        bug["subject"] for bug in report["bugs"]
+    )
+
+
+def render_report(version: str = None, format: str = "text") -> str | None:
+    """The report for `version` (the latest by default) in `format`, rendered once
+    per change to its file."""
+    if format not in FORMATS:
+        raise ValueError(f"Unknown report format {format!r}")
+
+    if version is None:
+        report = load_report()
+        if report is None:
+            return None
+        version = report["version"]
+
+    entry = _load(version)
+    if entry is None:
+        return None
+
+    with _lock:
+        if format not in entry["rendered"]:
+            entry["rendered"][format] = _render(entry["report"], format)
+
+        return entry["rendered"][format]
+
+
+def diff_reports(version: str = None, against: str = None) -> dict | None:
+    """What changed between `against` (the report before `version` by default) and
+    `version` (the latest by default).
+
+    `new` were fixed in this release only; `repeated` were already in the previous
+    report, which usually means a ticket was reopened and fixed again."""
+    current = load_report(version)
+    if current is None:
+        return None
+
+    against = against or previous_version(current["version"])
+    previous = load_report(against) if against else None
+    before = {_line(bug) for bug in previous["bugs"]} if previous else set()
+
+    return {
+        "version": current["version"],
+        "previous": previous and previous["version"],
+        "new": [_line(bug) for bug in current["bugs"] if _line(bug) not in before],
+        "repeated": [_line(bug) for bug in current["bugs"] if _line(bug) in before],
+    }
+
+
+def render_diff(diff: dict, format: str = "text") -> str:
+    if format not in FORMATS:
+        raise ValueError(f"Unknown report format {format!r}")
+
+    if format == "json":
+        return json.dumps(diff, indent=2)
+
+    previous = diff["previous"] or "nothing"
+    if format == "markdown":
+        escape = _escape_markdown
+        lines = [f"## Version {escape(diff['version'])} against {escape(previous)}", ""]
+        lines += [f"- {escape(line)}" for line in diff["new"]]
+        if diff["repeated"]:
+            lines += ["", "### Fixed again", ""]
+            lines += [f"- {escape(line)}" for line in diff["repeated"]]
+        return "\n".join(lines) + "\n"
+
+    lines = [f"Version {diff['version']} against {previous}", "New fixes:"]
+    lines += diff["new"] or ["(none)"]
+    if diff["repeated"]:
+        lines += ["", "Fixed again:"] + diff["repeated"]
+    return "\n".join(lines)
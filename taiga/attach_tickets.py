@@ -1,23 +1,69 @@
-from taiga.utils import Client
+import requests
 
+from taiga.utils import Client, is_version_conflict
 
-def attach_tickets():
-    client = Client()
+VERSION_TAGS = ["release", "beta"]
+
+
+def current_epic(epics: list, version_tag: str) -> dict:
+    return next(
+        epic
+        for epic in epics
+        if epic["status_extra_info"]["name"] == "Current"
+        and version_tag in epic["subject"].lower()
+    )
+
+
+def attach_issue(client: Client, issue: dict, epics: dict):
+    """Attach `issue` to the current epic of each version tag it carries, then drop
+    those tags.
+
+    Attached first: if the tag went first and the attach failed, nothing would be
+    left to say the ticket still needs one. An epic it is already related to is
+    skipped, as Taiga refuses the same relation twice: that is the run that attached
+    it but failed to drop the tag, being run again."""
+    related = {epic["id"] for epic in issue.get("epics") or []}
+    tags = [tag[0] for tag in issue["tags"] if tag[0] in epics]
+    for tag in tags:
+        if epics[tag]["id"] not in related:
+            client.attach_issue_to_epic(epics[tag]["id"], issue["id"])
+
+    try:
+        client.update_story(
+            issue["id"],
+            issue["version"],
+            tags=[tag for tag in issue["tags"] if tag[0] not in epics],
+        )
+    except requests.HTTPError as e:
+        if not is_version_conflict(e.response):
+            raise
+
+        # Somebody edited it meanwhile; drop the tags from what it is now, so their
+        # edit stays.
+        current = client.get_story(issue["id"])
+        client.update_story(
+            current["id"],
+            current["version"],
+            tags=[tag for tag in current["tags"] if tag[0] not in epics],
+        )
+
+
+def attach_tickets(client: Client = None):
+    client = client or Client()
     client.auth()
 
     epics = client.list_epics()
-    for version_tag in ["release", "beta"]:
-        epic = next(
-            epic
-            for epic in epics
-            if epic["status_extra_info"]["name"] == "Current"
-            and version_tag in epic["subject"].lower()
-        )
-        issues = client.list_stories(tags=[version_tag])
-        for issue in issues:
-            client.update_story(
-                issue["id"],
-                issue["version"],
-                tags=[tag for tag in issue["tags"] if tag[0] != version_tag],
-            )
-            client.attach_issue_to_epic(epic["id"], issue["id"])
+    epics = {tag: current_epic(epics, tag) for tag in VERSION_TAGS}
+
+    # Taiga's tag filter requires every tag it is given, so each tag is listed on its
+    # own and a ticket carrying both comes up twice. Both are listed before anything
+    # changes, since removing the tags is what would shift the listings.
+    issues = {
+        issue["id"]: issue
+        for tag in VERSION_TAGS
+        for issue in client.list_stories(tags=[tag])
+    }
+
+    client.scheduler.map(
+        lambda issue: attach_issue(client, issue, epics), issues.values()
+    )
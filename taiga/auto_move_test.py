@@ -1,3 +1,5 @@
+import logging
+
 from taiga.utils import Client, status_mappings
 
 
@@ -18,20 +20,63 @@ def is_tested_entry(entry: dict):
     return checkbox[0]["value"]
 
 
-def auto_move_test():
-    client = Client()
+def find_tester(client: Client, story_id: int) -> str | None:
+    """Who ticked the tested box on `story_id`: the first tested entry in the order
+    Taiga lists the history, read a page at a time so the pages after it are never
+    fetched."""
+    for page in client.iter_history_pages(story_id):
+        for entry in page:
+            if is_tested_entry(entry):
+                return entry["user"]["name"]
+
+    return None
+
+
+def auto_move_test(client: Client = None):
+    client = client or Client()
     client.auth()
 
-    stories = client.list_stories(status=status_mappings["in-test"])
-
-    for story in stories:
-        attributes = client.get_story_attributes(story["id"])
-        if attributes["attributes_values"].get("44202", False):
-            history = client.get_issue_history(story["id"])
-            diff = next(entry for entry in history if is_tested_entry(entry))
-            client.update_story(
-                story["id"],
-                story["version"],
-                status=status_mappings["awaiting-release"],
-                comment=f"Tested by **{diff['user']['name']}**",
+    # Read in full before anything moves: the updates take stories out of this
+    # column, and would shift its pages under a listing still in progress.
+    stories = [
+        story
+        for page in client.iter_story_pages(
+            status=status_mappings["in-test"], prefetch=True
+        )
+        for story in page
+    ]
+
+    attributes = client.scheduler.map(
+        lambda story: client.get_story_attributes(story["id"]), stories
+    )
+    tested = [
+        story
+        for story, values in zip(stories, attributes)
+        if values["attributes_values"].get("44202", False)
+    ]
+
+    testers = client.scheduler.map(
+        lambda story: find_tester(client, story["id"]), tested
+    )
+
+    moves = []
+    for story, tester in zip(tested, testers):
+        if tester is None:
+            logging.warning(
+                "Story %s is ticked but no history says by whom", story["id"]
             )
+            continue
+
+        moves.append((story, tester))
+
+    # One PATCH each rather than the kanban bulk endpoint: the "Tested by" comment
+    # has to go with the move, and the bulk call cannot carry it.
+    client.scheduler.map(
+        lambda move: client.update_story(
+            move[0]["id"],
+            move[0]["version"],
+            status=status_mappings["awaiting-release"],
+            comment=f"Tested by **{move[1]}**",
+        ),
+        moves,
+    )
@@ -1,7 +1,8 @@
 import logging
 import sys
 
-from taiga.utils import Client, status_mappings
+from taiga.move_column import move_column
+from taiga.utils import Client
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,10 +18,6 @@ if __name__ == "__main__":
     name = " ".join(sys.argv[2:])
 
     if is_beta:
-        new_status = status_mappings["in-test"]
-        stories = client.list_stories(status=status_mappings["fixed-internally"])
-
-        for story in stories:
-            client.update_story(story["id"], story["version"], status=new_status)
+        move_column(client, "fixed-internally", "in-test")
 
     client.create_tag(name, "#4C566A")
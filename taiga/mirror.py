@@ -0,0 +1,376 @@
+"""A local copy of the Taiga board in SQLite, so reads stop pulling the whole board.
+
+Stories are kept as Taiga returned them, beside the few columns they are queried by,
+so :class:`MirroredClient` answers `list_stories` with the same dicts the API would.
+The copy is brought up to date with Taiga's `modified_date__gte` filter, which returns
+only what changed since the last sync; a full sync now and then catches the stories
+that were deleted, which an incremental one cannot see.
+
+The webhook receiver marks the copy stale on every story event, so between events
+nothing is fetched at all.
+"""
+
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+
+from taiga.utils import Client, error_handler
+
+MIRROR_DB = "board.sqlite3"
+
+# Without a webhook event the copy is trusted this long before the next read syncs
+# it anyway - a safety net for a missed or disabled webhook, not the freshness path.
+MIRROR_MAX_AGE = 3600
+# An incremental sync cannot see a deleted story, so the copy is rebuilt this often.
+MIRROR_FULL_SYNC_AGE = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    id INTEGER PRIMARY KEY,
+    status INTEGER NOT NULL,
+    kanban_order INTEGER,
+    modified_date TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stories_by_status ON stories (status, kanban_order);
+
+CREATE TABLE IF NOT EXISTS story_tags (
+    tag TEXT NOT NULL,
+    story_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, story_id)
+);
+
+CREATE TABLE IF NOT EXISTS epics (
+    id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS statuses (
+    id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS attributes (
+    story_id INTEGER PRIMARY KEY,
+    modified_date TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class BoardMirror:
+    def __init__(self, path: str = MIRROR_DB):
+        self.path = path
+        self._lock = threading.Lock()
+
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per call: the app reads this from request threads and the
+        # webhook writes to it from others, and sqlite3 connections do not share.
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode = WAL")
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _get(self, db: sqlite3.Connection, key: str) -> str | None:
+        row = db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, db: sqlite3.Connection, key: str, value):
+        db.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+            (key, None if value is None else str(value)),
+        )
+
+    def _store_story(self, db: sqlite3.Connection, story: dict):
+        db.execute(
+            "INSERT OR REPLACE INTO stories (id, status, kanban_order, modified_date, data)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                story["id"],
+                story["status"],
+                story.get("kanban_order"),
+                story["modified_date"],
+                json.dumps(story),
+            ),
+        )
+        db.execute("DELETE FROM story_tags WHERE story_id = ?", (story["id"],))
+        db.executemany(
+            "INSERT OR IGNORE INTO story_tags (tag, story_id) VALUES (?, ?)",
+            [(tag[0], story["id"]) for tag in story["tags"] or []],
+        )
+
+    def sync(self, client: Client, *, full: bool = False):
+        """Bring the copy up to date, fetching only what changed unless `full`."""
+        with self._lock:
+            with self._connect() as db:
+                # Taken before fetching: an event that lands mid-sync leaves the copy
+                # stale for the next read rather than being cleared with this one.
+                events = self._get(db, "events")
+                last_full = float(self._get(db, "full_synced_at") or 0)
+                since = self._get(db, "stories_modified")
+
+            full = (
+                full or since is None or time.time() - last_full > MIRROR_FULL_SYNC_AGE
+            )
+
+            # Everything is fetched before the write transaction opens, so the webhook
+            # is never left waiting on Taiga for the database lock.
+            stories = client.list_stories(modified_since=None if full else since)
+            statuses = client.list_statuses() if full else None
+            # Epics are a handful and have no modified filter worth trusting, so they
+            # are always replaced whole.
+            epics = client.list_epics()
+
+            with self._connect() as db:
+                if full:
+                    db.execute("DELETE FROM stories")
+                    db.execute("DELETE FROM story_tags")
+                    db.execute("DELETE FROM statuses")
+                    db.executemany(
+                        "INSERT INTO statuses (id, slug, data) VALUES (?, ?, ?)",
+                        [
+                            (status["id"], status["slug"], json.dumps(status))
+                            for status in statuses
+                        ],
+                    )
+                    self._set(db, "full_synced_at", time.time())
+
+                for story in stories:
+                    self._store_story(db, story)
+
+                db.execute("DELETE FROM epics")
+                db.executemany(
+                    "INSERT INTO epics (id, data) VALUES (?, ?)",
+                    [(epic["id"], json.dumps(epic)) for epic in epics],
+                )
+
+                # Taiga's own timestamps rather than this machine's clock, so a skewed
+                # Pi cannot make the next sync skip a change. `gte` re-fetches the
+                # newest story every time, which is the price of never missing one.
+                newest = max(
+                    (story["modified_date"] for story in stories), default=since
+                )
+                self._set(db, "stories_modified", newest)
+                self._set(db, "synced_at", time.time())
+                self._set(db, "synced_events", events)
+
+        logging.info(
+            "Synced board mirror (%s): %d stories fetched",
+            "full" if full else "incremental",
+            len(stories),
+        )
+
+    def refresh(self, client: Client):
+        """Sync if a webhook has said the board changed, or the copy is too old."""
+        with self._connect() as db:
+            dirty = self._get(db, "events") != self._get(db, "synced_events")
+            synced_at = float(self._get(db, "synced_at") or 0)
+
+        if dirty or time.time() - synced_at > MIRROR_MAX_AGE:
+            self.sync(client)
+
+    def mark_dirty(self):
+        with self._connect() as db:
+            self._bump(db)
+
+    def _bump(self, db: sqlite3.Connection):
+        db.execute(
+            "INSERT INTO state (key, value) VALUES ('events', 1)"
+            " ON CONFLICT (key) DO UPDATE SET value = value + 1"
+        )
+
+    def apply_event(self, data: dict):
+        """Take note of a Taiga webhook event.
+
+        Webhook payloads are not shaped like the REST API's stories (no version, the
+        status nested, tags without colours), so a change is not written from them: it
+        only marks the copy stale, and the next read fetches what changed. A deletion
+        is applied directly, since no sync short of a full one would notice it.
+        """
+        if data.get("type") not in ("userstory", "epic"):
+            return
+
+        with self._connect() as db:
+            if data["type"] == "userstory":
+                story_id = data["data"]["id"]
+                if data["action"] == "delete":
+                    db.execute("DELETE FROM stories WHERE id = ?", (story_id,))
+                    db.execute("DELETE FROM story_tags WHERE story_id = ?", (story_id,))
+                # Custom attribute edits do not always move the story's modified
+                # date, so the cached values are dropped on any event for it.
+                db.execute("DELETE FROM attributes WHERE story_id = ?", (story_id,))
+
+            self._bump(db)
+
+    def apply_moves(self, moved: list):
+        """Write the `{id, status, kanban_order}` rows a bulk kanban move returned into
+        the copy.
+
+        Taiga makes that move as one bulk update, which neither moves the stories'
+        modified dates nor sends a webhook per story, so no incremental sync would
+        ever fetch it."""
+        with self._lock, self._connect() as db:
+            statuses = {
+                status_id: json.loads(data)
+                for status_id, data in db.execute("SELECT id, data FROM statuses")
+            }
+            for row in moved:
+                found = db.execute(
+                    "SELECT data FROM stories WHERE id = ?", (row["id"],)
+                ).fetchone()
+                if found is None:
+                    continue
+
+                story = json.loads(found[0])
+                story.update(status=row["status"], kanban_order=row["kanban_order"])
+                if status := statuses.get(row["status"]):
+                    story["status_extra_info"] = {
+                        key: status.get(key) for key in ("name", "color", "is_closed")
+                    }
+                db.execute(
+                    "UPDATE stories SET status = ?, kanban_order = ?, data = ?"
+                    " WHERE id = ?",
+                    (
+                        story["status"],
+                        story["kanban_order"],
+                        json.dumps(story),
+                        row["id"],
+                    ),
+                )
+
+    def expire(self):
+        """Have the next read rebuild the copy from a full sync."""
+        with self._connect() as db:
+            self._set(db, "full_synced_at", 0)
+            self._bump(db)
+
+    def list_stories(self, *, status: int = None, tags: list = None) -> list:
+        query = "SELECT data FROM stories"
+        clauses, params = [], []
+
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+
+        # Every tag has to match, as with Taiga's own `tags` filter.
+        for tag in tags or []:
+            clauses.append("id IN (SELECT story_id FROM story_tags WHERE tag = ?)")
+            params.append(tag)
+
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+
+        with self._connect() as db:
+            rows = db.execute(query + " ORDER BY kanban_order, id", params).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def list_epics(self) -> list:
+        with self._connect() as db:
+            rows = db.execute("SELECT data FROM epics ORDER BY id").fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def list_statuses(self) -> list:
+        with self._connect() as db:
+            rows = db.execute("SELECT data FROM statuses ORDER BY id").fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def get_story_attributes(self, client: Client, story_id: int) -> dict:
+        """The story's custom attribute values, fetched only if the story has changed
+        since they were last read."""
+        with self._connect() as db:
+            story = db.execute(
+                "SELECT modified_date FROM stories WHERE id = ?", (story_id,)
+            ).fetchone()
+            cached = db.execute(
+                "SELECT modified_date, data FROM attributes WHERE story_id = ?",
+                (story_id,),
+            ).fetchone()
+
+        if story and cached and cached[0] == story[0]:
+            return json.loads(cached[1])
+
+        attributes = client.get_story_attributes(story_id)
+        if story:
+            with self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO attributes (story_id, modified_date, data)"
+                    " VALUES (?, ?, ?)",
+                    (story_id, story[0], json.dumps(attributes)),
+                )
+
+        return attributes
+
+
+class MirroredClient(Client):
+    """A :class:`Client` whose listings come from the local copy.
+
+    Writes still go to Taiga, and each one marks the copy stale, so a read after a
+    write sees it. Bulk kanban moves are written into the copy as well, since a sync
+    cannot see them."""
+
+    def __init__(self, *args, mirror: BoardMirror = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mirror = mirror or BoardMirror()
+        self.session.hooks["response"] = [error_handler, self._mark_dirty_on_write]
+
+    def _mark_dirty_on_write(self, r, *args, **kwargs):
+        if r.request.method != "GET" and not r.request.url.endswith("/auth"):
+            self.mirror.mark_dirty()
+
+    # The mirror syncs through `super()`, the plain API listings: handing it `self`
+    # would have it sync from itself.
+    def list_stories(
+        self, *, status: int = None, tags: list = None, modified_since: str = None
+    ) -> list:
+        if modified_since is not None:
+            return super().list_stories(
+                status=status, tags=tags, modified_since=modified_since
+            )
+
+        self.mirror.refresh(super())
+        return self.mirror.list_stories(status=status, tags=tags)
+
+    def bulk_order_stories(self, issues: list, status: int) -> list | None:
+        moved = super().bulk_order_stories(issues, status)
+        if moved is None:
+            # An older Taiga that does not say what it moved; only a full sync sees
+            # a bulk move.
+            self.mirror.expire()
+        else:
+            self.mirror.apply_moves(moved)
+
+        return moved
+
+    def list_epics(self) -> list:
+        self.mirror.refresh(super())
+        return self.mirror.list_epics()
+
+    def get_story_attributes(self, story_id: int) -> dict:
+        return self.mirror.get_story_attributes(super(), story_id)
+
+
+def sync():
+    client = Client()
+    client.auth()
+
+    BoardMirror().sync(client, full=True)
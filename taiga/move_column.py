@@ -1,15 +1,72 @@
+import logging
+from collections.abc import Callable
+
+from taiga.mirror import BoardMirror, MirroredClient
 from taiga.utils import Client, status_mappings
 
+# Stories per bulk call. Taiga takes any number in one request, but the whole list
+# is one transaction on its side, so a large column is sent in slices.
+BULK_MOVE_SIZE = 100
 
-def move_column(client: Client, old_status, new_status):
-    stories = client.list_stories(status=status_mappings[old_status])
 
-    for story in stories:
-        client.update_story(
-            story["id"],
-            story["version"],
-            status=status_mappings[new_status],
+def move_chunk(
+    client: Client, chunk: list, status: int, on_moved: Callable | None = None
+):
+    on_moved = on_moved or (lambda ids: None)
+    moved = client.bulk_order_stories([story["id"] for story in chunk], status)
+    if moved is None:
+        # An empty answer means Taiga took the whole slice.
+        on_moved([story["id"] for story in chunk])
+        return
+
+    moved_ids = {story["id"] for story in moved}
+    on_moved([story["id"] for story in chunk if story["id"] in moved_ids])
+
+    rejected = [story for story in chunk if story["id"] not in moved_ids]
+    for story in rejected:
+        logging.warning(
+            "Bulk move skipped story %s, updating it on its own", story["id"]
+        )
+
+    def move_one(story: dict):
+        client.update_story(story["id"], story["version"], status=status)
+        on_moved([story["id"]])
+
+    client.scheduler.map(move_one, rejected)
+
+
+def move_stories(
+    client: Client, stories: list, status: int, on_moved: Callable | None = None
+):
+    """Move `stories` into `status` through the kanban bulk endpoint, the slices
+    concurrently.
+
+    The bulk call carries no `version`, so somebody editing a ticket mid-release no
+    longer aborts the move. Only the stories Taiga leaves out of its answer are sent
+    again, one PATCH each. `on_moved` is called with the IDs of each batch Taiga has
+    confirmed, from whichever thread sent it.
+
+    A bulk move is invisible to the board mirror's incremental sync, so unless the
+    client wrote it into the mirror itself, the mirror is expired afterwards - even
+    when a slice failed, as the others may have landed."""
+    chunks = [
+        stories[start : start + BULK_MOVE_SIZE]
+        for start in range(0, len(stories), BULK_MOVE_SIZE)
+    ]
+    try:
+        client.scheduler.map(
+            lambda chunk: move_chunk(client, chunk, status, on_moved), chunks
         )
+    finally:
+        if not isinstance(client, MirroredClient):
+            BoardMirror().expire()
+
+
+def move_column(client: Client, old_status, new_status):
+    for stories in client.drain_story_pages(
+        status=status_mappings[old_status], prefetch=True
+    ):
+        move_stories(client, stories, status_mappings[new_status])
 
 
 def simple_move_column():
@@ -1,5 +1,7 @@
 import logging
+from collections import defaultdict
 
+from taiga.mirror import MirroredClient
 from taiga.utils import Client, status_mappings
 
 
@@ -11,18 +13,37 @@ def sort_tags(story):
     return valid_tags[0]
 
 
-def sort():
+def sort(client: Client = None):
     logging.info("Starting sorting")
 
-    client = Client()
+    client = client or MirroredClient()
     client.auth()
 
-    for status in status_mappings.values():
-        stories = client.list_stories(status=status)
-        if not stories:
-            continue
+    # Every column it reorders is posted back whole, so a story the copy still has in
+    # its old column would be moved back into it: the diff is taken from a full sync.
+    if isinstance(client, MirroredClient):
+        client.mirror.sync(super(MirroredClient, client), full=True)
+
+    columns = defaultdict(list)
+    for story in client.list_stories():
+        columns[story["status"]].append(story)
 
-        stories.sort(key=sort_tags)
-        client.bulk_order_stories([story["id"] for story in stories], status)
+    changed = []
+    for status in status_mappings.values():
+        current = sorted(
+            columns[status], key=lambda story: (story["kanban_order"], story["id"])
+        )
+        # A stable sort, so stories sharing a tag keep the order they already have
+        # and a column that is already sorted comes out identical.
+        wanted = sorted(current, key=sort_tags)
+        if [story["id"] for story in wanted] != [story["id"] for story in current]:
+            changed.append((status, [story["id"] for story in wanted]))
+
+    logging.info(
+        "%d of %d column(s) need reordering", len(changed), len(status_mappings)
+    )
+    client.scheduler.map(
+        lambda column: client.bulk_order_stories(column[1], column[0]), changed
+    )
 
     logging.info("Done sorting")
@@ -1,4 +1,17 @@
+import contextlib
+import json
 import logging
+import os
+import pathlib
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 import requests
 
@@ -7,6 +20,22 @@ from taiga.config import BASE_URL, PASSWORD, PROJECT_ID, STATUS_MAPPING, USERNAM
 status_mappings = STATUS_MAPPING
 
 REQUEST_TIMEOUT = 30
+# Stories per page when a listing is streamed rather than fetched whole.
+PAGE_SIZE = 100
+# Where the auth token outlives the process, so consecutive cli.py runs and flows
+# do not each log in again. It is a credential: the file is kept owner-only.
+TOKEN_CACHE_FILE = pathlib.Path(__file__).with_name(".token.json")
+AUTH_PATHS = ("/auth", "/auth/refresh")
+# How many Taiga calls may be in flight at once, before any 429 narrows it.
+MAX_CONCURRENCY = 8
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+MAX_BACKOFF = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# How long a GET is answered from the session's cache before it goes back to Taiga.
+# Sized for one flow's repeated reads; any write empties the cache regardless.
+CACHE_TTL = 60
 
 
 def error_handler(r: requests.Response, *args, **kwargs):
@@ -17,13 +46,366 @@ def error_handler(r: requests.Response, *args, **kwargs):
         raise
 
 
+def retry_after(response: requests.Response) -> float | None:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def backoff(attempt: int) -> float:
+    # Full jitter: concurrent calls that failed together do not retry together.
+    return random.uniform(0, min(MAX_BACKOFF, RETRY_BASE_DELAY * 2**attempt))
+
+
+class Scheduler:
+    """Decides when a Taiga call may go out, and runs batches of calls concurrently.
+
+    Every request waits for one of `limit` slots. A 429 halves the limit and holds
+    every call back until its Retry-After has passed; each round of successes after
+    that gives one slot back. Bulk work therefore runs as wide as Taiga currently
+    allows, and narrows rather than fails when it is told to slow down."""
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.active = 0
+        self.rate_limits = 0
+
+        self._resume_at = 0.0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._condition:
+            while True:
+                wait = self._resume_at - time.monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    break
+
+                self._condition.wait(timeout=wait if wait > 0 else None)
+
+            self.active += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                self._condition.notify_all()
+
+    def rate_limited(self, delay: float):
+        with self._condition:
+            self.rate_limits += 1
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+        logging.warning(
+            "Taiga rate limited us, pausing %.1fs at %d concurrent call(s)",
+            delay,
+            self.limit,
+        )
+
+    def succeeded(self):
+        with self._condition:
+            if self.limit >= self.max_concurrency:
+                return
+
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                self.limit += 1
+                self._condition.notify_all()
+
+    def map(self, function: Callable, items) -> list:
+        """`function` over `items` concurrently, results in order.
+
+        Every call runs to the end before the first exception, if any, is raised, so
+        a failure does not leave the rest of a batch half-sent."""
+        items = list(items)
+        if not items:
+            return []
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_concurrency, len(items))
+        ) as pool:
+            futures = [pool.submit(function, item) for item in items]
+
+        return [future.result() for future in futures]
+
+
+def endpoint(method: str, url: str) -> str:
+    """The call `url` makes, with its IDs folded out: `GET /userstories/{id}`."""
+    path = urllib.parse.urlsplit(url).path
+    path = re.sub(r"^/api/v\d+", "", path)
+    return f"{method.upper()} " + re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+@dataclass
+class EndpointStats:
+    calls: int = 0
+    cached: int = 0
+    retries: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    slowest: float = 0.0
+    statuses: Counter = field(default_factory=Counter)
+
+
+class Metrics:
+    """What a session's calls cost, per endpoint: so a slow release can be pinned on
+    Taiga, the network or our own loop."""
+
+    def __init__(self):
+        self.endpoints = defaultdict(EndpointStats)
+        self._lock = threading.Lock()
+
+    def record(
+        self, name: str, seconds: float, status: int | None, size: int, retry: bool
+    ):
+        with self._lock:
+            stats = self.endpoints[name]
+            stats.calls += 1
+            stats.retries += retry
+            stats.bytes += size
+            stats.seconds += seconds
+            stats.slowest = max(stats.slowest, seconds)
+            stats.statuses[status or "error"] += 1
+
+    def record_cached(self, name: str):
+        with self._lock:
+            self.endpoints[name].cached += 1
+
+    def summary(self) -> list[str]:
+        """The total, then one line per endpoint, the most time-consuming first -
+        in that order so that a truncated summary still leads with the total."""
+        with self._lock:
+            endpoints = sorted(
+                self.endpoints.items(), key=lambda item: item[1].seconds, reverse=True
+            )
+
+        lines = [
+            f"Total: {sum(s.calls for _, s in endpoints)} call(s), "
+            f"{sum(s.cached for _, s in endpoints)} cached, "
+            f"{sum(s.retries for _, s in endpoints)} retried, "
+            f"{sum(s.bytes for _, s in endpoints) / 1024:.0f} KB, "
+            f"{sum(s.seconds for _, s in endpoints):.2f}s in Taiga"
+        ]
+        for name, stats in endpoints:
+            statuses = ", ".join(
+                f"{status}×{count}"
+                for status, count in sorted(stats.statuses.items(), key=str)
+            )
+            lines.append(
+                f"{name}: {stats.calls} call(s), {stats.cached} cached, "
+                f"{stats.retries} retried, {stats.bytes / 1024:.0f} KB, "
+                f"{stats.seconds:.2f}s total, {stats.slowest:.2f}s slowest"
+                + (f" [{statuses}]" if statuses else "")
+            )
+
+        return lines
+
+
+# One per process: Taiga rate limits the account, not the Client object.
+default_scheduler = Scheduler()
+
+
 class TimeoutSession(requests.Session):
     """Session that applies a default timeout, so a stalled Taiga API cannot hang
-    a request thread or a release build forever."""
+    a request thread or a release build forever.
 
-    def request(self, *args, **kwargs):
+    A 401 calls `reauth` and replays the request once, so a cached token that Taiga
+    has expired since the last run costs a refresh rather than a failed flow.
+
+    GETs are cached by URL and parameters for `cache_ttl` seconds, and revalidated
+    with If-None-Match when Taiga sent an ETag. Any other method empties the cache:
+    a flow reads the same column several times between its writes, and after a
+    write nothing it read before can be trusted."""
+
+    def __init__(
+        self,
+        reauth: Callable[[], None] = None,
+        cache_ttl: float = CACHE_TTL,
+        scheduler: "Scheduler" = None,
+    ):
+        super().__init__()
+        self.reauth = reauth
+        self.scheduler = scheduler or default_scheduler
+        self.metrics = Metrics()
+        self.cache_ttl = cache_ttl
+
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_revalidated = 0
+        self._cache_lock = threading.Lock()
+        # Bumped by every write, so a GET that was in flight across one - a prefetched
+        # page, say - does not put what it read before the write into the cache.
+        self._generation = 0
+
+    def _send(self, method, url, *args, **kwargs) -> requests.Response:
+        """Send through the scheduler, retrying what is safe to retry.
+
+        A 429 is retried for any method, since Taiga refused it before doing anything.
+        Other transient failures are only retried for idempotent methods: a POST that
+        timed out may well have gone through."""
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        name = endpoint(method, url)
+        reauthed = False
+        attempt = 0
+        while True:
+            try:
+                with self.scheduler.slot():
+                    started = time.perf_counter()
+                    # Reset for every attempt, so a failure recorded below is never
+                    # this attempt's exception paired with the last one's response.
+                    response = None
+                    try:
+                        response = super().request(method, url, *args, **kwargs)
+                    except requests.HTTPError as e:
+                        response = e.response
+                        raise
+                    finally:
+                        self.metrics.record(
+                            name,
+                            time.perf_counter() - started,
+                            response.status_code if response is not None else None,
+                            len(response.content) if response is not None else 0,
+                            retry=attempt > 0 or reauthed,
+                        )
+            except requests.HTTPError as e:
+                status = e.response.status_code
+                if (
+                    status == 401
+                    and not reauthed
+                    and self.reauth is not None
+                    and not url.endswith(AUTH_PATHS)
+                ):
+                    reauthed = True
+                    self.reauth()
+                    continue
+
+                retryable = status == 429 or (idempotent and status in RETRY_STATUSES)
+                if not retryable or attempt >= MAX_RETRIES:
+                    raise
+
+                delay = retry_after(e.response) or backoff(attempt)
+                if status == 429:
+                    # Everybody waits, not just this call: the next request would only
+                    # be refused as well.
+                    self.scheduler.rate_limited(delay)
+                else:
+                    time.sleep(delay)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt >= MAX_RETRIES:
+                    raise
+
+                time.sleep(backoff(attempt))
+            else:
+                self.scheduler.succeeded()
+                return response
+
+            attempt += 1
+            logging.warning("Retrying %s %s (attempt %d)", method, url, attempt + 1)
+
+    def invalidate(self):
+        with self._cache_lock:
+            self._generation += 1
+            self.cache.clear()
+
+    def request(self, method, url, *args, **kwargs):
         kwargs.setdefault("timeout", REQUEST_TIMEOUT)
-        return super().request(*args, **kwargs)
+        if method.upper() != "GET" or args:
+            # Before and after: a GET from another thread may land in between.
+            self.invalidate()
+            try:
+                return self._send(method, url, *args, **kwargs)
+            finally:
+                self.invalidate()
+
+        # Pagination is switched on and off by a header, so it is part of the key.
+        headers = kwargs.get("headers") or {}
+        key = (
+            requests.Request("GET", url, params=kwargs.get("params")).prepare().url,
+            headers.get("x-disable-pagination"),
+        )
+
+        with self._cache_lock:
+            generation = self._generation
+            cached = self.cache.get(key)
+
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            self.cache_hits += 1
+            self.metrics.record_cached(endpoint(method, url))
+            return cached[1]
+
+        etag = cached[1].headers.get("ETag") if cached else None
+        if etag:
+            kwargs["headers"] = {**headers, "If-None-Match": etag}
+
+        response = self._send(method, url, **kwargs)
+        if response.status_code == 304 and cached:
+            self.cache_revalidated += 1
+            response = cached[1]
+
+        with self._cache_lock:
+            if generation == self._generation:
+                self.cache[key] = (time.monotonic(), response)
+
+        return response
+
+
+def _load_tokens(path: pathlib.Path | None) -> dict:
+    if path is None:
+        return {}
+
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def safe_name(text: str) -> str:
+    """`text` as a file name that stays in its directory, for names that come from
+    a form. Everything but ASCII letters, digits, `.` and `-` is written as `_` and
+    its hex bytes, so two different names never land on the same file."""
+    return re.sub(
+        r"[^A-Za-z0-9.-]",
+        lambda match: "".join(f"_{byte:02x}" for byte in match[0].encode()),
+        text,
+    )
+
+
+def atomic_write(path: pathlib.Path, text: str, mode: int = 0o644):
+    """Write `text` beside `path` and swap it in, so a reader - in this process or
+    another - sees the old file or the new one, never half of either. `mode` is
+    applied as the file is created, not after."""
+    temporary = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+
+    os.replace(temporary, path)
+
+
+def _save_tokens(path: pathlib.Path | None, tokens: dict):
+    if path is None:
+        return
+
+    # Owner-only: it is a credential.
+    atomic_write(path, json.dumps(tokens), mode=0o600)
+
+
+def is_version_conflict(response: requests.Response) -> bool:
+    """Whether Taiga refused a write because the object's `version` moved on."""
+    if response.status_code != 400:
+        return False
+
+    try:
+        return "version" in response.json()
+    except ValueError:
+        return False
 
 
 class Client:
@@ -33,17 +415,40 @@ class Client:
         username: str = USERNAME,
         password: str = PASSWORD,
         project_id: int = PROJECT_ID,
+        token_cache: pathlib.Path | None = TOKEN_CACHE_FILE,
     ):
         self.base_url = base_url
         self.username = username
         self.password = password
         self.project_id = project_id
+        self.token_cache = token_cache
 
-        self.header = None
-        self.session = TimeoutSession()
+        # The token lives on the session rather than in here, so a refresh reaches
+        # requests that are already being retried with this dict.
+        self.header = {"x-disable-pagination": "True"}
+        self.session = TimeoutSession(reauth=self.refresh)
+        self.scheduler = self.session.scheduler
         self.session.hooks = {"response": error_handler}
 
-    def auth(self) -> dict:
+        self._token_key = f"{self.username}@{self.base_url}"
+        self._token_lock = threading.Lock()
+        self._token = None
+
+    def _use_token(self, payload: dict):
+        self._token = payload
+        self.session.headers["Authorization"] = f"Bearer {payload['auth_token']}"
+
+        tokens = _load_tokens(self.token_cache)
+        tokens[self._token_key] = {
+            "auth_token": payload["auth_token"],
+            "refresh": payload.get("refresh"),
+        }
+        _save_tokens(self.token_cache, tokens)
+
+    def _login(self) -> dict:
+        # Never with the old token attached: Taiga rejects a stale bearer before it
+        # looks at the credentials.
+        self.session.headers.pop("Authorization", None)
         response = self.session.post(
             self.base_url + "/auth",
             data={
@@ -54,12 +459,47 @@ class Client:
         )
 
         payload = response.json()
-        self.header = {
-            "Authorization": f"Bearer {payload['auth_token']}",
-            "x-disable-pagination": "True",
-        }
+        self._use_token(payload)
         return payload
 
+    def auth(self) -> dict:
+        """Authenticate, reusing the token an earlier run cached if there is one.
+
+        A cached token is not checked here: the first request that Taiga refuses
+        refreshes it, which costs nothing in the usual case where it is still good."""
+        cached = _load_tokens(self.token_cache).get(self._token_key)
+        if cached is None:
+            return self._login()
+
+        self._token = cached
+        self.session.headers["Authorization"] = f"Bearer {cached['auth_token']}"
+        return cached
+
+    def refresh(self):
+        """Trade the refresh token for a new auth token, or log in again if Taiga
+        will not."""
+        stale = self._token
+        with self._token_lock:
+            # Another thread got the 401 first and has already replaced the token.
+            if self._token is not stale:
+                return
+
+            if not stale or not stale.get("refresh"):
+                self._login()
+                return
+
+            self.session.headers.pop("Authorization", None)
+            try:
+                response = self.session.post(
+                    self.base_url + "/auth/refresh", json={"refresh": stale["refresh"]}
+                )
+            except requests.HTTPError:
+                logging.info("Taiga refused the refresh token, logging in again")
+                self._login()
+                return
+
+            self._use_token(response.json())
+
     def get_issue_history(self, issue_id: int):
         response = self.session.get(
             self.base_url + f"/history/userstory/{issue_id}",
@@ -68,7 +508,18 @@ class Client:
 
         return response.json()
 
-    def list_stories(self, *, status: int = None, tags: list = None) -> list:
+    def iter_history_pages(
+        self, issue_id: int, *, page_size: int = PAGE_SIZE
+    ) -> Iterator[list]:
+        """:meth:`get_issue_history` a page at a time, so a caller that finds what it
+        wants can stop reading early."""
+        yield from self._pages(
+            f"/history/userstory/{issue_id}", {}, page_size=page_size, prefetch=False
+        )
+
+    def list_stories(
+        self, *, status: int = None, tags: list = None, modified_since: str = None
+    ) -> list:
         params = {
             "project": self.project_id,
         }
@@ -79,12 +530,96 @@ class Client:
         if tags is not None:
             params["tags"] = ",".join(tags)
 
+        if modified_since is not None:
+            params["modified_date__gte"] = modified_since
+
         response = self.session.get(
             self.base_url + "/userstories", headers=self.header, params=params
         )
 
         return response.json()
 
+    def _pages(
+        self, path: str, params: dict, *, page_size: int, prefetch: bool
+    ) -> Iterator[list]:
+        """Yield a listing one page at a time, following Taiga's `x-pagination-next`.
+
+        With `prefetch`, the next page is requested on a background thread while the
+        caller works through the current one. An endpoint Taiga does not paginate
+        answers without the header and comes back as a single page."""
+        # Everything in the usual header but the switch that turns pagination off.
+        headers = {
+            key: value
+            for key, value in self.header.items()
+            if key != "x-disable-pagination"
+        }
+
+        def fetch(url: str, params: dict = None) -> requests.Response:
+            return self.session.get(url, headers=headers, params=params)
+
+        pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            response = fetch(self.base_url + path, {**params, "page_size": page_size})
+            while True:
+                # The next URL carries every parameter already.
+                next_url = response.headers.get("x-pagination-next")
+                upcoming = pool.submit(fetch, next_url) if pool and next_url else None
+
+                yield response.json()
+
+                if not next_url:
+                    return
+
+                response = upcoming.result() if upcoming else fetch(next_url)
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+    def iter_story_pages(
+        self,
+        *,
+        status: int = None,
+        tags: list = None,
+        page_size: int = PAGE_SIZE,
+        prefetch: bool = False,
+    ) -> Iterator[list]:
+        """:meth:`list_stories` a page at a time, so work can start on the first page
+        and memory does not grow with the board.
+
+        Only for reads: a caller that moves stories out of the filter it is listing
+        shifts every later page, and skips stories. Such a caller wants
+        :meth:`drain_story_pages`."""
+        params = {"project": self.project_id}
+
+        if status is not None:
+            params["status"] = status
+
+        if tags is not None:
+            params["tags"] = ",".join(tags)
+
+        yield from self._pages(
+            "/userstories", params, page_size=page_size, prefetch=prefetch
+        )
+
+    def drain_story_pages(self, **filters) -> Iterator[list]:
+        """:meth:`iter_story_pages`, for a caller that moves stories out of the filter.
+
+        Moving page one shifts page two's stories forward into the page that was just
+        read, so the listing is walked again until a pass turns up nothing new. Each
+        story is yielded once, including those the caller chose to leave in place."""
+        seen = set()
+        while True:
+            found = False
+            for page in self.iter_story_pages(**filters):
+                fresh = [story for story in page if story["id"] not in seen]
+                if fresh:
+                    found = True
+                    seen.update(story["id"] for story in fresh)
+                    yield fresh
+
+            if not found:
+                return
+
     def list_epics(self):
         response = self.session.get(
             self.base_url + "/epics",
@@ -96,6 +631,17 @@ class Client:
 
         return response.json()
 
+    def list_statuses(self) -> list:
+        response = self.session.get(
+            self.base_url + "/userstory-statuses",
+            headers=self.header,
+            params={
+                "project": self.project_id,
+            },
+        )
+
+        return response.json()
+
     def attach_issue_to_epic(self, epic_id: int, issue_id: int):
         self.session.post(
             self.base_url + f"/epics/{epic_id}/related_userstories",
@@ -103,8 +649,12 @@ class Client:
             data={"epic": epic_id, "user_story": issue_id},
         )
 
-    def bulk_order_stories(self, issues: list, status: int):
-        self.session.post(
+    def bulk_order_stories(self, issues: list, status: int) -> list | None:
+        """Put `issues` into `status`, in that order, in a single call.
+
+        Returns the stories Taiga reports as updated, or None from an older Taiga
+        that answers 204 and does not say."""
+        response = self.session.post(
             self.base_url + "/userstories/bulk_update_kanban_order",
             headers=self.header,
             json={
@@ -114,6 +664,8 @@ class Client:
             },
         )
 
+        return response.json() if response.content else None
+
     def update_story(
         self,
         us_id: int,
@@ -134,10 +686,32 @@ class Client:
         if comment is not None:
             data["comment"] = comment
 
-        self.session.patch(
-            self.base_url + f"/userstories/{us_id}", headers=self.header, json=data
+        try:
+            self.session.patch(
+                self.base_url + f"/userstories/{us_id}", headers=self.header, json=data
+            )
+        except requests.HTTPError as e:
+            # A status or a comment means the same against whatever somebody changed
+            # meanwhile, so it is replayed on the current version. A tag list does
+            # not: it replaces the story's tags, and would undo their edit.
+            if tags is not None or not is_version_conflict(e.response):
+                raise
+
+            logging.info(
+                "Story %s changed under us, retrying on its new version", us_id
+            )
+            data["version"] = self.get_story(us_id)["version"]
+            self.session.patch(
+                self.base_url + f"/userstories/{us_id}", headers=self.header, json=data
+            )
+
+    def get_story(self, us_id: int) -> dict:
+        response = self.session.get(
+            self.base_url + f"/userstories/{us_id}", headers=self.header
         )
 
+        return response.json()
+
     def update_epic(
         self, epic_id: int, version: int, *, status: str = None, order: str = None
     ):